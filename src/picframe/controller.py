@@ -348,7 +348,7 @@ class Controller:
                             image_attr['location'] = pics[0].location
                         else:
                             field_name = self.__model.EXIF_TO_FIELD[key]
-                            image_attr[key] = pics[0].__dict__[field_name]  # TODO nicer using namedtuple for Pic
+                            image_attr[key] = getattr(pics[0], field_name)
                     if self.__mqtt_config['use_mqtt']:
                         self.publish_state(pics[0].fname, image_attr)
 
@@ -358,6 +358,9 @@ class Controller:
             else:
                 self.__model.pause_looping = self.__viewer.is_in_transition()
                 (loop_running, skip_image) = self.__viewer.slideshow_is_running(pics, time_delay, fade_time, self.__paused)
+                if pics is not None and self.__viewer.lookahead > 0:
+                    # only now the current slide is loaded start preparing the next ones in the background
+                    self.__viewer.prefetch(self.__model.get_upcoming_pics(self.__viewer.lookahead))
             
             if not loop_running:
                 break
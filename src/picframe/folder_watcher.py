@@ -0,0 +1,116 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# events returned by InotifyWatcher.read_events()
+CHANGED = 'changed'
+DELETED = 'deleted'
+FOLDER_CREATED = 'folder_created'
+FOLDER_DELETED = 'folder_deleted'
+OVERFLOW = 'overflow'
+
+
+class InotifyWatcher:
+    """Reports files and folders changed below the watched folders using Linux inotify.
+
+    inotify isn't recursive so each folder has to be added with add_watch(). New folders
+    are reported as FOLDER_CREATED and the caller has to add them (and their subfolders).
+    Raises OSError if inotify isn't available i.e. not on Linux.
+    """
+
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len followed by len bytes of name
+
+    def __init__(self):
+        self.__logger = logging.getLogger("folder_watcher.InotifyWatcher")
+        try:
+            self.__libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.__libc.inotify_init1  # AttributeError if not linux
+        except (OSError, AttributeError) as e:
+            raise OSError("inotify not available: {}".format(e))
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.__watches = {}  # wd -> folder
+        self.__folders = {}  # folder -> wd
+
+    def add_watch(self, folder):
+        if folder in self.__folders:
+            return
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:  # ENOSPC means fs.inotify.max_user_watches is too small
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), folder)
+        self.__watches[wd] = folder
+        self.__folders[folder] = wd
+
+    def __remove_watches(self, folder):
+        prefix = folder + os.sep
+        for name in [f for f in self.__folders if f == folder or f.startswith(prefix)]:
+            wd = self.__folders.pop(name)
+            self.__watches.pop(wd, None)
+            self.__libc.inotify_rm_watch(self.__fd, wd)  # fails harmlessly if already removed by the kernel
+
+    def read_events(self):
+        """Returns a list of (event, path) tuples for everything that happened since the last call.
+        Never blocks, the list is empty if nothing happened."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, _cookie, length = InotifyWatcher.EVENT_HEADER.unpack_from(data, pos)
+                pos += InotifyWatcher.EVENT_HEADER.size
+                name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    self.__logger.warning("inotify event queue overflowed")
+                    events.append((OVERFLOW, None))
+                    continue
+                if mask & IN_IGNORED:  # watched folder has gone
+                    folder = self.__watches.pop(wd, None)
+                    if folder is not None:
+                        self.__folders.pop(folder, None)
+                    continue
+                folder = self.__watches.get(wd)
+                if folder is None or not name:
+                    continue
+                path = os.path.join(folder, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        events.append((FOLDER_CREATED, path))
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.__remove_watches(path)
+                        events.append((FOLDER_DELETED, path))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    events.append((CHANGED, path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    events.append((DELETED, path))
+        return events
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+        self.__watches.clear()
+        self.__folders.clear()
@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+class FrameCache:
+    """Keeps images already prepared for display (oriented, matted, blurred edges) as files
+    in cache_dir so a photo coming round again only has to be read back.
+
+    Entries are looked up by a key from make_key() which has to include everything that
+    changes the prepared image. When the files add up to more than max_size_mb the least
+    recently used ones are removed. The order survives restarts as get() touches the file.
+    """
+
+    FORMATS = {'jpeg': '.jpg', 'webp': '.webp', 'raw': '.npy'}
+
+    def __init__(self, cache_dir, max_size_mb, image_format='jpeg', quality=90):
+        self.__logger = logging.getLogger("frame_cache.FrameCache")
+        if image_format not in FrameCache.FORMATS:
+            self.__logger.warning("Invalid frame_cache_format %s, using jpeg", image_format)
+            image_format = 'jpeg'
+        self.__cache_dir = cache_dir
+        self.__max_size = int(max_size_mb * 1024 * 1024)
+        self.__format = image_format
+        self.__quality = quality
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # key -> (file name, size), least recently used first
+        self.__total_size = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.__load_entries()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    @property
+    def total_size(self):
+        return self.__total_size
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """Returns the cached PIL Image or None if there isn't one (or it can't be read)."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            self.__entries.move_to_end(key)
+        path = os.path.join(self.__cache_dir, entry[0])
+        try:
+            if path.endswith('.npy'):
+                im = Image.fromarray(np.load(path))
+            else:
+                im = Image.open(path)
+                im.load()
+            os.utime(path)
+        except Exception as e:
+            self.__logger.warning("Can't read cached frame %s: %s", path, e)
+            with self.__lock:
+                self.__remove(key)
+            return None
+        return im
+
+    def put(self, key, im):
+        ext = FrameCache.FORMATS[self.__format]
+        if ext == '.jpg' and im.mode not in ('RGB', 'L'):
+            ext = '.png'  # jpeg has no alpha channel, which blur_edges images have
+        name = key + ext
+        path = os.path.join(self.__cache_dir, name)
+        tmp_path = path + '.tmp'
+        try:
+            if ext == '.npy':
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, np.asarray(im))
+            elif ext == '.jpg':
+                im.save(tmp_path, 'JPEG', quality=self.__quality)
+            elif ext == '.webp':
+                im.save(tmp_path, 'WEBP', quality=self.__quality)
+            else:
+                im.save(tmp_path, 'PNG', compress_level=1)
+            os.replace(tmp_path, path)  # so get() never sees a partly written file
+            size = os.path.getsize(path)
+        except Exception as e:
+            self.__logger.warning("Can't write cached frame %s: %s", path, e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__total_size -= old[1]
+                if old[0] != name:
+                    self.__remove_file(old[0])
+            self.__entries[key] = (name, size)
+            self.__total_size += size
+            while self.__total_size > self.__max_size and len(self.__entries) > 1:
+                self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__total_size -= entry[1]
+            self.__remove_file(entry[0])
+
+    def __remove_file(self, name):
+        try:
+            os.remove(os.path.join(self.__cache_dir, name))
+        except OSError:
+            pass
+
+    def __load_entries(self):
+        found = []
+        with os.scandir(self.__cache_dir) as it:
+            for entry in it:
+                key, ext = os.path.splitext(entry.name)
+                if ext == '.tmp':  # left over from an interrupted put()
+                    self.__remove_file(entry.name)
+                    continue
+                if not entry.is_file() or ext not in ('.jpg', '.webp', '.npy', '.png'):
+                    continue
+                st = entry.stat()
+                found.append((st.st_mtime, key, entry.name, st.st_size))
+        for _mtime, key, name, size in sorted(found):
+            self.__entries[key] = (name, size)
+            self.__total_size += size
+        while self.__total_size > self.__max_size and self.__entries:  # frame_cache_size may have been reduced
+            self.__remove(next(iter(self.__entries)))
+        self.__logger.info("Frame cache has %d images, %.1f MB", len(self.__entries), self.__total_size / 1048576)
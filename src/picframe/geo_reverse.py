@@ -1,4 +1,6 @@
+import csv
 import json
+import math
 import urllib.request
 import locale
 import logging
@@ -7,15 +9,36 @@ URL = "https://nominatim.openstreetmap.org/reverse?format=geojson&lat={}&lon={}&
 
 
 class GeoReverse:
-    def __init__(self, geo_key, zoom=18, key_list=None):
+    """Looks up addresses from Nominatim. Coordinates in the same grid cell of cell_size degrees
+    share one lookup, cell_size 0 looks up every coordinate."""
+
+    def __init__(self, geo_key, zoom=18, key_list=None, cell_size=0.0):
         self.__logger = logging.getLogger("geo_reverse.GeoReverse")
         self.__geo_key = geo_key
         self.__zoom = zoom
         self.__key_list = key_list
-        self.__geo_locations = {}
+        self.__cell_size = cell_size
+        self.__geo_locations = {}  # cell -> address already looked up
         self.__language = locale.getlocale()[0][:2]
 
+    def __cell(self, lat, lon):
+        if not self.__cell_size:
+            return None
+        return (math.floor(lat / self.__cell_size), math.floor(lon / self.__cell_size))
+
+    def cell_bounds(self, lat, lon):
+        """(min_lat, max_lat, min_lon, max_lon) of the grid cell lat, lon is in, the max values
+        not included, or None if cells aren't used."""
+        cell = self.__cell(lat, lon)
+        if cell is None:
+            return None
+        return (cell[0] * self.__cell_size, (cell[0] + 1) * self.__cell_size,
+                cell[1] * self.__cell_size, (cell[1] + 1) * self.__cell_size)
+
     def get_address(self, lat, lon):
+        cell = self.__cell(lat, lon)
+        if cell in self.__geo_locations:
+            return self.__geo_locations[cell]
         try:
             with urllib.request.urlopen(URL.format(lat, lon, self.__zoom, self.__geo_key, self.__language),
                                         timeout=3.0) as req:
@@ -31,7 +54,85 @@ class GeoReverse:
                             break  # add just the first one from the options
             else:
                 adr_list = adr.values()
-            return ", ".join(adr_list)
+            address = ", ".join(adr_list)
+            if cell is not None and address:
+                self.__geo_locations[cell] = address
+            return address
         except Exception as e:  # TODO return different thing for different exceptions
             self.__logger.error("lat=%f, lon=%f -> %s", lat, lon, e)
             return ""
+
+
+class LocalGeoReverse:
+    """Looks up the nearest place in a local file instead of on the internet. The file is either a
+    GeoNames dump (tab separated, i.e. cities15000.txt from https://download.geonames.org/export/dump/)
+    giving "name, country code" or a csv file with a header line including latitude and longitude
+    columns, the address being the other columns joined in order. Places further than max_distance km
+    away aren't used.
+    """
+
+    EARTH_RADIUS = 6371.0  # km
+    KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180.0
+
+    def __init__(self, file_name, max_distance=50.0):
+        self.__logger = logging.getLogger("geo_reverse.LocalGeoReverse")
+        self.__max_distance = max_distance
+        self.__grid = {}  # (int lat, int lon) 1 degree cell -> list of (lat, lon, address)
+        with open(file_name, encoding='utf-8', newline='') as f:
+            first_line = f.readline()
+            f.seek(0)
+            if first_line.count('\t') >= 14:
+                places = self.__read_geonames(f)
+            else:
+                places = self.__read_csv(f)
+            n = 0
+            for lat, lon, address in places:
+                self.__grid.setdefault((math.floor(lat), math.floor(lon) % 360), []).append((lat, lon, address))
+                n += 1
+        self.__logger.info("Loaded %d places from %s", n, file_name)
+
+    @staticmethod
+    def __read_geonames(f):
+        for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if len(row) > 8:
+                yield (float(row[4]), float(row[5]), ", ".join(part for part in (row[1], row[8]) if part))
+
+    @staticmethod
+    def __read_csv(f):
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in next(reader)]
+        lat_col, lon_col = header.index('latitude'), header.index('longitude')
+        for row in reader:
+            if len(row) < len(header):
+                continue
+            address = ", ".join(val.strip() for i, val in enumerate(row) if i not in (lat_col, lon_col) and val.strip())
+            yield (float(row[lat_col]), float(row[lon_col]), address)
+
+    def __distance(self, lat1, lon1, lat2, lon2):  # haversine, km
+        lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        return 2 * LocalGeoReverse.EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+    def cell_bounds(self, lat, lon):
+        return None  # looking up is quicker than sharing results
+
+    def get_address(self, lat, lon):
+        # check every 1 degree cell that could hold a place within max_distance
+        d_lat = math.ceil(self.__max_distance / LocalGeoReverse.KM_PER_DEGREE)
+        cos_lat = max(math.cos(math.radians(min(abs(lat) + d_lat, 90.0))), 0.01)
+        d_lon = min(math.ceil(self.__max_distance / (LocalGeoReverse.KM_PER_DEGREE * cos_lat)), 180)
+        cell_lat, cell_lon = math.floor(lat), math.floor(lon)
+        # nearest by the flat earth approximation, which is plenty over max_distance, then checked properly
+        x_scale = math.cos(math.radians(lat))
+        best, best_d2 = None, float('inf')
+        for i in range(cell_lat - d_lat, cell_lat + d_lat + 1):
+            for j in range(cell_lon - d_lon, cell_lon + d_lon + 1):
+                for place in self.__grid.get((i, j % 360), ()):
+                    dx = ((place[1] - lon + 180.0) % 360.0 - 180.0) * x_scale
+                    dy = place[0] - lat
+                    d2 = dx * dx + dy * dy
+                    if d2 < best_d2:
+                        best, best_d2 = place, d2
+        if best is None or self.__distance(lat, lon, best[0], best[1]) > self.__max_distance:
+            return ""
+        return best[2]
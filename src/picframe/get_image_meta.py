@@ -1,5 +1,5 @@
 import logging
-from PIL import Image
+from PIL import Image, IptcImagePlugin
 from PIL.ExifTags import TAGS, GPSTAGS
 from fractions import Fraction
 
@@ -13,24 +13,46 @@ except ImportError:
 
 class GetImageMeta:
 
-    def __init__(self, filename):
+    def __init__(self, filename, header_only=True):
         self.__logger = logging.getLogger("get_image_meta.GetImageMeta")
         self.__tags = {}
         self.__filename = filename  # in case no exif data in which case needed for size
-        image = self.get_image_object(filename)
-        if image:
-            exif = image.getexif()
-            self.__do_image_tags(exif)
-            self.__do_exif_tags(exif)
-            self.__do_geo_tags(exif)
-            self.__do_iptc_keywords()
-            try:
-                xmp = image.getxmp()
-                if len(xmp) > 0:
-                    self.__do_xmp_keywords(xmp)
-            except Exception as e:
-                xmp = {}
-                self.__logger.warning("PILL getxmp() failed: %s -> %s", filename, e)
+        self.__size = None  # set from the header if header_only, otherwise get_size() opens the image again
+        if header_only:
+            self.__read_header(filename)
+        else:  # original full decode path, kept for comparison in test/benchmark_get_image_meta.py
+            image = self.get_image_object(filename)
+            if image:
+                self.__do_exif(image)
+                self.__do_iptc_keywords()
+                self.__do_xmp(image)
+
+    def __read_header(self, filename):
+        # Image.open() is lazy and only parses the header and meta data segments, the pixel data
+        # is never decoded as long as nothing calls load(), convert() etc. on it
+        try:
+            with open(filename, 'rb') as fh, Image.open(fh) as image:
+                self.__size = image.size
+                self.__do_exif(image)
+                self.__do_pil_iptc_keywords(image)
+                self.__do_xmp(image)
+        except Exception as e:
+            self.__logger.warning("Can't open file: \"%s\"", filename)
+            self.__logger.warning("Cause: %s", e)
+
+    def __do_exif(self, image):
+        exif = image.getexif()
+        self.__do_image_tags(exif)
+        self.__do_exif_tags(exif)
+        self.__do_geo_tags(exif)
+
+    def __do_xmp(self, image):
+        try:
+            xmp = image.getxmp()
+            if len(xmp) > 0:
+                self.__do_xmp_keywords(xmp)
+        except Exception as e:
+            self.__logger.warning("PILL getxmp() failed: %s -> %s", self.__filename, e)
 
     def __do_image_tags(self, exif):
         tags = {
@@ -133,6 +155,34 @@ class GetImageMeta:
             self.__logger.warning("IPTC loading has failed - if you want to use this you will need to install iptcinfo3 %s -> %s",  # noqa: E501
                                   self.__filename, e)
 
+    def __do_pil_iptc_keywords(self, image):
+        # IPTC IIM blocks are parsed by PIL along with the rest of the header (JPEG APP13, TIFF).
+        # Unlike IPTCInfo(force=True) this doesn't fall back to a byte by byte scan of the whole
+        # file for other formats, which will have their keywords etc in XMP anyway
+        try:
+            iptc = IptcImagePlugin.getiptcinfo(image)
+            if not iptc:
+                return
+            # tags
+            val = iptc.get((2, 25))
+            if val:
+                if not isinstance(val, list):  # single keyword isn't returned as a list
+                    val = [val]
+                keywords = ''
+                for key in val:
+                    keywords += key.decode('utf-8') + ','  # decode binary strings
+                self.__tags['IPTC Keywords'] = keywords
+            # caption
+            val = iptc.get((2, 120))
+            if val:
+                self.__tags['IPTC Caption/Abstract'] = val.decode('utf8')
+            # title
+            val = iptc.get((2, 5))
+            if val:
+                self.__tags['IPTC Object Name'] = val.decode('utf-8')
+        except Exception as e:
+            self.__logger.warning("IPTC loading has failed: %s -> %s", self.__filename, e)
+
     def has_exif(self):
         if self.__tags == {}:
             return False
@@ -220,6 +270,8 @@ class GetImageMeta:
             return None
 
     def get_size(self):
+        if self.__size is not None:
+            return self.__size
         try:  # corrupt image file might crash app
             return GetImageMeta.get_image_object(self.__filename).size
         except Exception as e:
@@ -227,11 +279,21 @@ class GetImageMeta:
             return (0, 0)
 
     @staticmethod
-    def get_image_object(fname):
+    def get_image_object(fname, size=None):
+        # If size (width, height) is given the image is only decoded down to just above that size.
+        # JPEG uses draft() which scales the DCT by 1/2, 1/4 or 1/8 while decoding, other formats
+        # are reduced by an integer factor straight after loading
         try:
             image = Image.open(fname)
-            if image.mode not in ("RGB", "RGBA"):  # mat system needs RGB or more
+            is_jpeg = image.format == 'JPEG'  # format is None after convert()
+            if size is not None and is_jpeg:
+                image.draft('RGB', size)
+            if image.mode not in ("RGB", "RGBA"):  # mat system needs RGB or more, reduce() can't do P, 1 or I;16
                 image = image.convert("RGB")
+            if size is not None and not is_jpeg:
+                factor = min(image.width // size[0], image.height // size[1])
+                if factor >= 2:
+                    image = image.reduce(factor)
         # raise # the system should be able to withstand files being moved etc without crashing
         except Exception as e:
             logger = logging.getLogger("get_image_meta.GetImageMeta")
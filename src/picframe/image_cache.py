@@ -2,14 +2,16 @@ import sqlite3
 import os
 import time
 import logging
+import multiprocessing
 import threading
 import sys
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import iptcinfo3
 
 # Add the root directory to sys.path
 #sys.path.append(str(Path(__file__).resolve().parent.parent))
-from picframe import get_image_meta
+from picframe import get_image_meta, folder_watcher
 
 
 class ImageCache:
@@ -27,8 +29,14 @@ class ImageCache:
                      'IPTC Keywords': 'tags',
                      'IPTC Caption/Abstract': 'caption',
                      'IPTC Object Name': 'title'}
-
-    def __init__(self, picture_dir, follow_links, db_file, geo_reverse, update_interval, portrait_pairs=False):
+    INSERT_BATCH_SIZE = 50  # number of files written and committed to the db in one transaction
+    GEO_MAX_BACKOFF = 3600.0  # longest wait (seconds) after repeated reverse geocoding failures
+    DB_MMAP_SIZE = 64 * 1024 * 1024  # bytes of the db file memory mapped by each connection
+    DB_CACHE_SIZE = -8000  # page cache of each connection, negative means KiB rather than pages
+
+    def __init__(self, picture_dir, follow_links, db_file, geo_reverse, update_interval, portrait_pairs=False,
+                 metadata_workers=1, metadata_pool='thread', watch_mode='poll', prune_folders=False,
+                 full_scan_interval=86400, geo_rate_limit=1.0, portrait_pairs_by=None):
         # TODO these class methods will crash if Model attempts to instantiate this using a
         # different version from the latest one - should this argument be taken out?
         self.__modified_folders = []
@@ -40,18 +48,54 @@ class ImageCache:
         self.__follow_links = follow_links
         self.__db_file = db_file
         self.__geo_reverse = geo_reverse
+        self.__geo_rate_limit = geo_rate_limit  # seconds between reverse geocoding requests
         self.__update_interval = update_interval
         self.__portrait_pairs = portrait_pairs  # TODO have a function to turn this on and off?
-        self.__db = self.__create_open_db(self.__db_file)
+        self.__portrait_pairs_by = portrait_pairs_by  # None (playlist order), 'date' or 'folder'
+        self.__metadata_workers = max(1, int(metadata_workers))
+        self.__executor = None  # only used if metadata_workers > 1
+        if self.__metadata_workers > 1:
+            if metadata_pool == 'process':
+                # not forked from this process, whose watcher, geo and reader threads might hold locks the
+                # children would then wait on for ever
+                start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self.__executor = ProcessPoolExecutor(max_workers=self.__metadata_workers,
+                                                      mp_context=multiprocessing.get_context(start_method))
+            else:
+                self.__executor = ThreadPoolExecutor(max_workers=self.__metadata_workers)
+        self.__watcher = None  # with inotify the whole picture_dir is only walked at start or purge_files()
+        if watch_mode == 'inotify':
+            try:
+                self.__watcher = folder_watcher.InotifyWatcher()
+            except OSError as e:
+                self.__logger.warning("Can't use inotify, falling back to polling -> %s", e)
+        self.__rescan = True  # walk picture_dir on the next update_cache()
+        self.__prune_folders = prune_folders  # don't list folders unchanged since the last scan
+        self.__full_scan_interval = full_scan_interval  # but do list them all at least this often (seconds)
+        self.__last_full_scan = 0.0
+        self.__folder_children = {}  # folder -> subfolders found by scandir() in this walk
+        self.__prefetched_rows = {}  # file_id -> all_data row read ahead by get_file_infos()
+        self.__display_stats = {}  # file_id -> [times displayed, last displayed] not written to the db yet
+        self.__display_stats_lock = threading.Lock()
+        self.__display_stats_tm = 0.0  # when __display_stats was last written
+        self.__db = self.__create_open_db(self.__db_file)  # the one connection that writes, from any thread
         self.__db_write_lock = threading.Lock()  # lock to serialize db writes between threads
+        self.__readers = threading.local()  # each thread reading the db has its own connection
+        self.__reader_list = []  # all of those so they can be closed at the end
+        self.__reader_lock = threading.Lock()
         # NB this is where the required schema is set
-        self.__update_schema(3)
+        self.__update_schema(6)
 
         self.__keep_looping = True
         self.__pause_looping = False
         self.__shutdown_completed = False
         self.__purge_files = False
+        self.__stop_event = threading.Event()  # wakes the geo thread up to stop
 
+        self.__geo_thread = None
+        if self.__geo_reverse is not None:
+            self.__geo_thread = threading.Thread(target=self.__geo_loop, daemon=True)
+            self.__geo_thread.start()
         t = threading.Thread(target=self.__loop)
         t.start()
 
@@ -63,11 +107,24 @@ class ImageCache:
                     if self.__keep_looping == False:
                         break
                     time.sleep(1)
+            elif time.time() > self.__display_stats_tm + self.__update_interval:
+                self.__flush_display_stats()  # update_cache() does this when not paused
             time.sleep(0.01)
 
+        if self.__geo_thread is not None:
+            self.__geo_thread.join()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+        if self.__watcher is not None:
+            self.__watcher.close()
+        self.__flush_display_stats()
         self.__db_write_lock.acquire()
         self.__db.commit()  # close after update_cache finished for last time
         self.__db_write_lock.release()
+        with self.__reader_lock:
+            for db in self.__reader_list:
+                db.close()
+            self.__reader_list.clear()
         self.__db.close()
         self.__shutdown_completed = True
 
@@ -76,12 +133,14 @@ class ImageCache:
 
     def stop(self):
         self.__keep_looping = False
+        self.__stop_event.set()
         while not self.__shutdown_completed:
             time.sleep(0.05)  # make function blocking to ensure staged shutdown
 
 
     def purge_files(self):
         self.__purge_files = True
+        self.__rescan = True
 
     def update_cache(self):
         """Update the cache database with new and/or modified files
@@ -89,124 +148,242 @@ class ImageCache:
 
         self.__logger.debug('Updating cache')
 
+        # With a watcher just pick up the files it has reported
+        if self.__watcher is not None:
+            self.__read_watcher_events()
+
         # If the current collection of updated files is empty, check for disk-based changes
-        if not self.__modified_files:
+        walked = False
+        if not self.__modified_files and (self.__watcher is None or self.__rescan):
             self.__logger.debug('No unprocessed files in memory, checking disk')
             self.__modified_folders = self.__get_modified_folders()
 
             self.__modified_files = self.__get_modified_files(self.__modified_folders)
             self.__logger.debug('Found %d new files on disk', len(self.__modified_files))
-            
+            self.__rescan = False
+            walked = True
+
         # While we have files to process and looping isn't paused
-        while self.__modified_files and not self.__pause_looping and self.__keep_looping:
-            file = self.__modified_files.pop(0)
-            self.__logger.debug('Inserting: %s', file)
-            self.__insert_file(file)
-        
+        if self.__executor is not None:
+            self.__insert_files_parallel()
+        else:
+            self.__insert_files()
+
         # If we've process all files in the current collection, update the cached folder info
         if not self.__modified_files and self.__keep_looping:
             self.__update_folder_info(self.__modified_folders)
             self.__modified_folders.clear()
         
         # If looping is still not paused, remove any files or folders from the db that are no longer on disk
-        if not self.__pause_looping and self.__keep_looping:
+        if not self.__pause_looping and self.__keep_looping and (self.__watcher is None or walked):
             self.__purge_missing_files_and_folders()
 
 
-        # Commit the current set of changes
-        self.__db_write_lock.acquire()
-        self.__db.commit()
-        self.__db_write_lock.release()
+        # Commit the current set of changes along with the display stats since last time
+        self.__flush_display_stats()
+
+    def __reader(self):
+        # With WAL readers see the last commit and neither wait for nor hold up the writer. An in-memory
+        # db can't be opened twice so that has to make do with the writer connection
+        db = getattr(self.__readers, 'db', None)
+        if db is None:
+            if self.__db_file == ':memory:':
+                return self.__db
+            db = sqlite3.connect(self.__db_file, check_same_thread=False)  # only closed by another thread
+            db.row_factory = sqlite3.Row
+            ImageCache.__set_pragmas(db)
+            db.execute("PRAGMA query_only = ON")
+            with self.__reader_lock:
+                self.__reader_list.append(db)
+            self.__readers.db = db
+        return db
 
     def query_cache(self, where_clause, sort_clause='fname ASC'):
-        cursor = self.__db.cursor()
+        cursor = self.__reader().cursor()
         cursor.row_factory = None  # we don't want the "sqlite3.Row" setting from the db here...
         try:
             if not self.__portrait_pairs:  # TODO SQL insertion? Does it matter in this app?
                 sql = """SELECT file_id FROM all_data WHERE {0} ORDER BY {1}
                     """.format(where_clause, sort_clause)
                 return cursor.execute(sql).fetchall()
-            else:  # make two SELECTS
-                sql = """SELECT
-                            CASE
-                                WHEN is_portrait = 0 THEN file_id
-                                ELSE -1
-                            END
-                            FROM all_data WHERE {0} ORDER BY {1}
-                                        """.format(where_clause, sort_clause)
-                full_list = cursor.execute(sql).fetchall()
-                sql = """SELECT file_id FROM all_data
-                            WHERE ({0}) AND is_portrait = 1 ORDER BY {1}
+            else:
+                sql = """SELECT file_id, is_portrait, exif_datetime, folder_name FROM all_data
+                            WHERE {0} ORDER BY {1}
                                         """.format(where_clause, sort_clause)
-                pair_list = cursor.execute(sql).fetchall()
-                newlist = []
-                skip_portrait_slot = False
-                for i in range(len(full_list)):
-                    if full_list[i][0] != -1:
-                        newlist.append(full_list[i])
-                    elif skip_portrait_slot:
-                        skip_portrait_slot = False
-                        continue
-                    elif pair_list:
-                        elem = pair_list.pop(0)
-                        if pair_list:
-                            elem += pair_list.pop(0)
-                            # Here, we just doubled-up a set of portrait images.
-                            # Skip the next available "portrait slot" as it's unneeded.
-                            skip_portrait_slot = True
-                        newlist.append(elem)
-                return newlist
+                return self.__pair_portraits(cursor.execute(sql).fetchall())
         except Exception:
             return []
 
+    def __pair_portraits(self, rows):
+        # rows are (file_id, is_portrait, exif_datetime, folder_name) in the order to show them. Portraits
+        # are paired up in that order or, with portrait_pairs_by, after sorting them by date or by date
+        # within each folder, never pairing two folders. Each pair takes the place of whichever of the two
+        # comes first, the other place is dropped
+        portraits = [i for i, row in enumerate(rows) if row[1]]
+        if self.__portrait_pairs_by == 'date':
+            portraits.sort(key=lambda i: rows[i][2] or 0)
+        groups = [portraits]
+        if self.__portrait_pairs_by == 'folder':
+            by_folder = {}
+            for i in portraits:
+                by_folder.setdefault(rows[i][3], []).append(i)
+            groups = [sorted(group, key=lambda i: rows[i][2] or 0) for group in by_folder.values()]
+        pairs = {}  # position of the first of the pair -> file_ids
+        for group in groups:
+            for k in range(0, len(group), 2):  # an odd one out is left on its own
+                pair = group[k:k + 2]
+                pairs[min(pair)] = tuple(rows[i][0] for i in pair)
+        return [pairs[i] if row[1] else (row[0],) for i, row in enumerate(rows) if not row[1] or i in pairs]
+
+    def get_display_stats(self, where_clause):
+        """Returns (file_id, last_displayed, rating) for the files matching where_clause."""
+        sql = """SELECT file_id,
+                        (SELECT last_displayed FROM file WHERE file.file_id = all_data.file_id),
+                        rating
+                 FROM all_data WHERE {0}""".format(where_clause)
+        cursor = self.__reader().cursor()
+        cursor.row_factory = None
+        try:
+            rows = cursor.execute(sql).fetchall()
+        except Exception:
+            return []
+        with self.__display_stats_lock:
+            if self.__display_stats:
+                rows = [(row[0], self.__display_stats[row[0]][1], row[2]) if row[0] in self.__display_stats else row
+                        for row in rows]
+        return rows
+
+    def get_file_infos(self, file_ids):
+        """Reads the all_data rows of file_ids in one query and returns them in the same order, None for
+        those not found. The rows are kept for the following get_file_info() calls, replacing any kept
+        from the previous call. Unlike get_file_info() this doesn't count the files as displayed."""
+        wanted = [file_id for file_id in file_ids if file_id]
+        rows = {}
+        if wanted:
+            sql = "SELECT * FROM all_data WHERE file_id IN ({0})".format(",".join("?" * len(wanted)))
+            rows = {row['file_id']: row for row in self.__reader().execute(sql, wanted).fetchall()}
+        self.__prefetched_rows = rows
+        return [rows.get(file_id) for file_id in file_ids]
+
     def get_file_info(self, file_id):
         if not file_id:
             return None
         sql = "SELECT * FROM all_data where file_id = {0}".format(file_id)
-        row = self.__db.execute(sql).fetchone()
+        row = self.__prefetched_rows.pop(file_id, None)
+        if row is None:
+            row = self.__reader().execute(sql).fetchone()
         try:
             if row is not None and row['last_modified'] != os.path.getmtime(row['fname']):
                 self.__logger.debug('Cache miss: File %s changed on disk', row['fname'])
-                self.__insert_file(row['fname'], file_id)
-                row = self.__db.execute(sql).fetchone()  # description inserted in table
+                self.__write_files([ImageCache.read_file_meta(row['fname'])])
+                row = self.__reader().execute(sql).fetchone()  # description inserted in table
         except OSError:
             self.__logger.warning("Image '%s' does not exists or is inaccessible", row['fname'])
-        if row is not None and row['latitude'] is not None and row['longitude'] is not None and row['location'] is None:
-            if self.__get_geo_location(row['latitude'], row['longitude']):
-                row = self.__db.execute(sql).fetchone()  # description inserted in table
-        sql = "UPDATE file SET displayed_count = displayed_count + 1, last_displayed = ? WHERE file_id = ?"
+        # NB a missing location is filled in by __geo_loop(), not here, so the slideshow never waits for it
+        with self.__display_stats_lock:  # written to the db by __flush_display_stats()
+            stats = self.__display_stats.setdefault(file_id, [0, 0.0])
+            stats[0] += 1
+            stats[1] = time.time()
+        return row  # NB if select fails (i.e. moved file) will return None
+
+    @property
+    def pending_display_stats(self):
+        """Number of files with display stats waiting to be written to the db."""
+        return len(self.__display_stats)
+
+    def __flush_display_stats(self):
+        # adds up the displayed_count and last_displayed of all the files shown since the last call in one
+        # executemany() and commits them along with anything else written since the last commit
+        with self.__display_stats_lock:
+            stats = [(count, last_displayed, file_id)
+                     for file_id, (count, last_displayed) in self.__display_stats.items()]
+            self.__display_stats = {}
+        sql = "UPDATE file SET displayed_count = displayed_count + ?, last_displayed = ? WHERE file_id = ?"
         starttime = round(time.time() * 1000)
         self.__db_write_lock.acquire()
         waittime = round(time.time() * 1000)
-        self.__db.execute(sql, (time.time(), file_id))  # Add file stats
-        self.__db_write_lock.release()
-        now = round(time.time() * 1000)
-        self.__logger.debug(
-            'Update file stats: Wait for %d ms and need %d ms for update ',
-            waittime - starttime, now - waittime)
-        return row  # NB if select fails (i.e. moved file) will return None
+        try:
+            if stats:
+                self.__db.executemany(sql, stats)
+            self.__db.commit()
+        except sqlite3.Error as e:  # the stats are only used to weight the choice of pictures, so lose them
+            self.__logger.warning("Can't write display stats: %s", e)
+        finally:
+            self.__db_write_lock.release()
+        self.__display_stats_tm = time.time()
+        if stats:
+            now = round(time.time() * 1000)
+            self.__logger.debug(
+                'Update file stats for %d files: Wait for %d ms and need %d ms for update ',
+                len(stats), waittime - starttime, now - waittime)
 
     def get_column_names(self):
         sql = "PRAGMA table_info(all_data)"
-        rows = self.__db.execute(sql).fetchall()
+        rows = self.__reader().execute(sql).fetchall()
         return [row['name'] for row in rows]
 
-    def __get_geo_location(self, lat, lon):  # TODO periodically check all lat/lon in meta with no location and try again # noqa: E501
-        location = self.__geo_reverse.get_address(lat, lon)
-        if len(location) == 0:
-            return False  # TODO this will continue to try even if there is some permanant cause
-        else:
-            sql = "INSERT OR REPLACE INTO location (latitude, longitude, description) VALUES (?, ?, ?)"
-            starttime = round(time.time() * 1000)
-            self.__db_write_lock.acquire()
-            waittime = round(time.time() * 1000)
-            self.__db.execute(sql, (lat, lon, location))
-            self.__db_write_lock.release()
-            now = round(time.time() * 1000)
-            self.__logger.debug(
-                'Update location: Wait for db %d ms and need %d ms for update ',
-                waittime - starttime, now - waittime)
-            return True
+    def __get_cell_location(self, lat, lon):
+        # description already stored for a nearby coordinate in the same geo_reverse grid cell
+        bounds = self.__geo_reverse.cell_bounds(lat, lon)
+        if bounds is None:
+            return None
+        sql = """SELECT description FROM location
+                 WHERE latitude >= ? AND latitude < ? AND longitude >= ? AND longitude < ? LIMIT 1"""
+        row = self.__reader().execute(sql, bounds).fetchone()
+        return None if row is None else row['description']
+
+    def __get_pending_locations(self):
+        sql = """SELECT DISTINCT meta.latitude, meta.longitude FROM meta
+                 LEFT JOIN location
+                    ON location.latitude = meta.latitude AND location.longitude = meta.longitude
+                 WHERE meta.latitude IS NOT NULL AND meta.longitude IS NOT NULL AND location.id IS NULL"""
+        return [(row[0], row[1]) for row in self.__reader().execute(sql).fetchall()]
+
+    def __geo_loop(self):
+        # Fills in the location of every lat/lon in meta without one, at most one request per
+        # geo_rate_limit seconds. Positions that fail are retried once the others have been done,
+        # each consecutive failure doubling the wait up to GEO_MAX_BACKOFF
+        failures = 0
+        failed = set()
+        while not self.__stop_event.is_set():
+            pending = [pos for pos in self.__get_pending_locations() if pos not in failed]
+            failed.clear()
+            if not pending:
+                self.__stop_event.wait(self.__update_interval)
+                continue
+            self.__logger.debug('Looking up %d locations', len(pending))
+            for lat, lon in pending:
+                if self.__stop_event.is_set():
+                    break
+                wait_tm = 0.0
+                location = self.__get_cell_location(lat, lon)
+                if location is None:
+                    location = self.__geo_reverse.get_address(lat, lon)
+                    wait_tm = self.__geo_rate_limit
+                if location:
+                    self.__set_geo_location(lat, lon, location)
+                    failures = 0
+                else:
+                    failed.add((lat, lon))
+                    failures += 1
+                    wait_tm = min(self.__geo_rate_limit * 2 ** min(failures, 20), ImageCache.GEO_MAX_BACKOFF)
+                    self.__logger.debug('No location for %f, %f, waiting %.0f s', lat, lon, wait_tm)
+                if wait_tm > 0.0:
+                    self.__stop_event.wait(wait_tm)
+
+    def __set_geo_location(self, lat, lon, location):
+        self.__prefetched_rows = {}  # might be missing this location
+        sql = "INSERT OR REPLACE INTO location (latitude, longitude, description) VALUES (?, ?, ?)"
+        starttime = round(time.time() * 1000)
+        self.__db_write_lock.acquire()
+        waittime = round(time.time() * 1000)
+        self.__db.execute(sql, (lat, lon, location))
+        self.__db.commit()  # for the reader connections to see it
+        self.__db_write_lock.release()
+        now = round(time.time() * 1000)
+        self.__logger.debug(
+            'Update location: Wait for db %d ms and need %d ms for update ',
+            waittime - starttime, now - waittime)
 
     def __create_open_db(self, db_file):
         sql_folder_table = """
@@ -306,12 +483,20 @@ class ImageCache:
 
         db = sqlite3.connect(db_file, check_same_thread=False)
         db.row_factory = sqlite3.Row  # make results accessible by field name
+        db.execute("PRAGMA journal_mode = WAL")  # stored in the db file so only needed by the writer
+        ImageCache.__set_pragmas(db)
         for item in (sql_folder_table, sql_file_table, sql_meta_table, sql_location_table, sql_meta_index,
                      sql_all_data_view, sql_db_info_table, sql_clean_file_trigger, sql_clean_meta_trigger):
             db.execute(item)
 
         return db
 
+    @staticmethod
+    def __set_pragmas(db):
+        db.execute("PRAGMA synchronous = NORMAL")  # with WAL only a power cut can lose the last commits
+        db.execute("PRAGMA mmap_size = {0}".format(ImageCache.DB_MMAP_SIZE))
+        db.execute("PRAGMA cache_size = {0}".format(ImageCache.DB_CACHE_SIZE))
+
     def __update_schema(self, required_db_schema_version):
         sql_select = "SELECT schema_version from db_info"
         schema_version = self.__db.execute(sql_select).fetchone()
@@ -356,6 +541,98 @@ class ImageCache:
                 self.__db.execute("ALTER TABLE file ADD COLUMN displayed_count INTEGER default 0 NOT NULL")
                 self.__db.execute("ALTER TABLE file ADD COLUMN last_displayed REAL DEFAULT 0 NOT NULL")
 
+            if schema_version <= 3:
+                # Migrate to db schema v4
+                # Add the names of the subfolders, "/" separated, found when the folder was last listed.
+                # With prune_folders these are checked directly instead of listing unchanged folders again
+                self.__db.execute("ALTER TABLE folder ADD COLUMN subfolders TEXT")
+
+            if schema_version <= 4:
+                # Migrate to db schema v5
+                # Full text index of the text fields used by tags_filter and location_filter, rowid is the
+                # file_id. Triggers keep it in step with the meta and location tables
+                self.__db.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS meta_fts USING fts5(tags, caption, title, location)""")
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS Meta_Fts_Insert_Trigger
+                    AFTER INSERT ON meta
+                    FOR EACH ROW
+                    BEGIN
+                        INSERT OR REPLACE INTO meta_fts (rowid, tags, caption, title, location)
+                        VALUES (NEW.file_id, NEW.tags, NEW.caption, NEW.title,
+                                (SELECT description FROM location
+                                    WHERE latitude = NEW.latitude AND longitude = NEW.longitude));
+                    END""")
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS Meta_Fts_Update_Trigger
+                    AFTER UPDATE ON meta
+                    FOR EACH ROW
+                    BEGIN
+                        DELETE FROM meta_fts WHERE rowid = OLD.file_id;
+                        INSERT INTO meta_fts (rowid, tags, caption, title, location)
+                        VALUES (NEW.file_id, NEW.tags, NEW.caption, NEW.title,
+                                (SELECT description FROM location
+                                    WHERE latitude = NEW.latitude AND longitude = NEW.longitude));
+                    END""")
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS Meta_Fts_Delete_Trigger
+                    AFTER DELETE ON meta
+                    FOR EACH ROW
+                    BEGIN
+                        DELETE FROM meta_fts WHERE rowid = OLD.file_id;
+                    END""")
+                # the location triggers find the files of a position with this rather than a scan of meta
+                self.__db.execute("CREATE INDEX IF NOT EXISTS meta_location ON meta (latitude, longitude)")
+                # NB INSERT OR REPLACE INTO location doesn't fire a delete trigger for the replaced row
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS Location_Fts_Insert_Trigger
+                    AFTER INSERT ON location
+                    FOR EACH ROW
+                    BEGIN
+                        UPDATE meta_fts SET location = NEW.description WHERE rowid IN
+                            (SELECT file_id FROM meta WHERE latitude = NEW.latitude AND longitude = NEW.longitude);
+                    END""")
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS Location_Fts_Delete_Trigger
+                    AFTER DELETE ON location
+                    FOR EACH ROW
+                    BEGIN
+                        UPDATE meta_fts SET location = NULL WHERE rowid IN
+                            (SELECT file_id FROM meta WHERE latitude = OLD.latitude AND longitude = OLD.longitude);
+                    END""")
+                self.__db.execute("""
+                    INSERT INTO meta_fts (rowid, tags, caption, title, location)
+                    SELECT meta.file_id, meta.tags, meta.caption, meta.title, location.description
+                    FROM meta
+                        LEFT JOIN location
+                            ON location.latitude = meta.latitude AND location.longitude = meta.longitude""")
+
+            if schema_version <= 5:
+                # Migrate to db schema v6
+                # Add folder_name to the all_data view. Selecting a folder and its subfolders with
+                # folder_name = ? OR (folder_name >= '<name>/' AND folder_name < '<name>0') uses the
+                # index on folder.name where fname LIKE '<name>/%' has to go through every file
+                self.__db.execute("DROP VIEW all_data")
+                self.__db.execute("""
+                    CREATE VIEW IF NOT EXISTS all_data
+                    AS
+                    SELECT
+                        folder.name || "/" || file.basename || "." || file.extension AS fname,
+                        folder.name AS folder_name,
+                        file.last_modified,
+                        meta.*,
+                        meta.height > meta.width as is_portrait,
+                        location.description as location
+                    FROM file
+                        INNER JOIN folder
+                            ON folder.folder_id = file.folder_id
+                        LEFT JOIN meta
+                            ON file.file_id = meta.file_id
+                        LEFT JOIN location
+                            ON location.latitude = meta.latitude AND location.longitude = meta.longitude
+                    WHERE folder.missing = 0
+                    """)
+
             # Finally, update the db's schema version stamp to the app's requested version
             self.__db.execute('DELETE FROM db_info')
             self.__db.execute('INSERT INTO db_info VALUES(?)', (required_db_schema_version,))
@@ -368,110 +645,289 @@ class ImageCache:
     # --- Note that all folders returned currently exist on disk
     def __get_modified_folders(self):
         out_of_date_folders = []
-        sql_select = "SELECT * FROM folder WHERE name = ?"
-
-        subfolders  = []
-        for dirpath, dirnames, _ in os.walk(self.__picture_dir, followlinks=self.__follow_links):
-            if not self.__keep_looping:
-                return out_of_date_folders
-            # Filter out unwanted directories
-            dirnames[:] = [d for d in dirnames if not d.startswith(".") and d != "@eaDir"]
-            # Append the current directory path
-            subfolders.append(dirpath)
-
+        # load the whole folder table once rather than one SELECT per directory
+        sql_select = "SELECT name, last_modified, missing, subfolders FROM folder"
+        db_folders = {row['name']: (row['last_modified'], row['missing'], row['subfolders'])
+                      for row in self.__db.execute(sql_select)}
+        self.__folder_children = {}
+        known_folders = None
+        if self.__prune_folders:
+            if time.time() - self.__last_full_scan < self.__full_scan_interval:
+                known_folders = db_folders
+            else:
+                self.__last_full_scan = time.time()
 
-        for directory in subfolders:
+        for directory, mod_tm in self.__walk_folders(self.__picture_dir, known_folders):
             if not self.__keep_looping:
                 return out_of_date_folders
-
-        
-        #for dir in [d[1] for d in os.walk(self.__picture_dir, followlinks=self.__follow_links)]:
-         #   print(dir)
-        #    if os.path.basename(dir):
-        #        if os.path.basename(dir)[0] == '.'or os.path.basename(dir)[0] =='@':
-         #           print('discarded')
-         #           print(dir)
-          #          continue  # ignore hidden folders
-          #  print('ok')
-          #  print(dir)
-            mod_tm = int(os.stat(directory).st_mtime)
-            found = self.__db.execute(sql_select, (directory,)).fetchone()
-            if not found or found['last_modified'] < mod_tm or found['missing'] == 1:
+            self.__watch_folder(directory)
+            found = db_folders.get(directory)
+            if not found or found[0] < mod_tm or found[1] == 1:
                 out_of_date_folders.append((directory, mod_tm))
+            elif directory in self.__folder_children and self.__folder_children[directory] == found[2]:
+                del self.__folder_children[directory]  # nothing to update for this one
         return out_of_date_folders
 
+    def __walk_folders(self, top, known_folders=None):
+        # Like os.walk() but yields (dirpath, mtime) with the mtime taken from the DirEntry of the
+        # parent's scandir() so no separate stat per directory. Hidden and @eaDir folders are skipped
+        # and symlinked folders only followed if follow_links.
+        # Any change of the entries in a folder changes its mtime, so folders found in known_folders
+        # with the same mtime aren't listed again, only their stored subfolders are stat()ed
+        try:
+            stack = [(top, int(os.stat(top).st_mtime))]
+        except OSError as e:
+            self.__logger.warning("Can't read folder %s -> %s", top, e)
+            return
+        while stack:
+            dirpath, mod_tm = stack.pop()
+            yield dirpath, mod_tm
+            known = known_folders.get(dirpath) if known_folders is not None else None
+            if known is not None and known[0] == mod_tm and known[1] == 0 and known[2] is not None:
+                for name in known[2].split("/") if known[2] else []:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stack.append((path, int(os.stat(path).st_mtime)))
+                    except OSError:
+                        continue  # removed since, it will be listed properly once dirpath's mtime changes
+                continue
+            children = []
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(".") or entry.name == "@eaDir":
+                            continue
+                        try:
+                            if not entry.is_dir() or (entry.is_symlink() and not self.__follow_links):
+                                continue
+                            stack.append((entry.path, int(entry.stat().st_mtime)))
+                            children.append(entry.name)
+                        except OSError:
+                            continue  # e.g. broken link or folder removed meanwhile
+            except OSError as e:
+                self.__logger.warning("Can't read folder %s -> %s", dirpath, e)
+                continue
+            self.__folder_children[dirpath] = "/".join(sorted(children))  # "/" can't be part of a name
+
+    def __watch_folder(self, directory):
+        if self.__watcher is None:
+            return
+        try:
+            self.__watcher.add_watch(directory)
+        except OSError as e:  # most likely fs.inotify.max_user_watches reached
+            self.__logger.warning("Can't watch %s, falling back to polling -> %s", directory, e)
+            self.__watcher.close()
+            self.__watcher = None
+
+    def __read_watcher_events(self):
+        deleted_files = []
+        deleted_folders = []
+        new_folders = []
+        for event, path in self.__watcher.read_events():
+            if event == folder_watcher.OVERFLOW:
+                self.__rescan = True  # events have been lost, only a full walk can catch up
+            elif event == folder_watcher.CHANGED:
+                name = os.path.basename(path)
+                if (os.path.splitext(name)[1].lower() in ImageCache.EXTENSIONS and not name.startswith('.')
+                        and path not in self.__modified_files):
+                    self.__modified_files.append(path)
+            elif event == folder_watcher.DELETED:
+                if path in self.__modified_files:
+                    self.__modified_files.remove(path)
+                deleted_files.append(path)
+            elif event == folder_watcher.FOLDER_CREATED:
+                name = os.path.basename(path)
+                if not name.startswith(".") and name != "@eaDir":
+                    for directory, mod_tm in self.__walk_folders(path):
+                        self.__watch_folder(directory)
+                        new_folders.append((directory, mod_tm))
+            elif event == folder_watcher.FOLDER_DELETED:
+                deleted_folders.append(path)
+            if self.__watcher is None:  # failed to add a watch, update_cache() will walk picture_dir from now on
+                return
+        if new_folders:
+            self.__modified_folders.extend(new_folders)
+            for file in self.__get_modified_files(new_folders):
+                if file not in self.__modified_files:
+                    self.__modified_files.append(file)
+        if deleted_files or deleted_folders:
+            self.__delete_files_and_folders(deleted_files, deleted_folders)
+
+    def __delete_files_and_folders(self, files, folders):
+        # Files the watcher has seen deleted or moved away are removed from the db. Folders are only
+        # flagged as missing, as __purge_missing_files_and_folders() does, in case they come back
+        sql_delete_file = """
+            DELETE FROM file WHERE folder_id = (SELECT folder_id FROM folder WHERE name = ?)
+                AND basename = ? AND extension = ?"""
+        sql_missing_folder = "UPDATE folder SET missing = 1 WHERE name = ? OR substr(name, 1, ?) = ?"
+        file_list = []
+        for file in files:
+            dir, file_only = os.path.split(file)
+            base, extension = os.path.splitext(file_only)
+            file_list.append((dir, base, extension.lstrip(".")))
+        folder_list = [(folder, len(folder) + 1, folder + os.sep) for folder in folders]
+        self.__db_write_lock.acquire()
+        try:
+            self.__db.executemany(sql_delete_file, file_list)
+            self.__db.executemany(sql_missing_folder, folder_list)
+            self.__db.commit()
+        finally:
+            self.__db_write_lock.release()
+
     def __get_modified_files(self, modified_folders):
         out_of_date_files = []
-        # sql_select = "SELECT fname, last_modified FROM all_data WHERE fname = ? and last_modified >= ?"
+        # one query per folder for all the files it already has in the db
         sql_select = """
-        SELECT file.basename, file.last_modified
+        SELECT file.basename, file.extension, file.last_modified
             FROM file
                 INNER JOIN folder
                     ON folder.folder_id = file.folder_id
-            WHERE file.basename = ? AND file.extension = ? AND folder.name = ? AND file.last_modified >= ?
+            WHERE folder.name = ?
         """
         for dir, _date in modified_folders:
-            for file in os.listdir(dir):
-                if not self.__keep_looping:
-                    return out_of_date_folders
-                base, extension = os.path.splitext(file)
-                if (extension.lower() in ImageCache.EXTENSIONS
-                        # have to filter out all the Apple junk
-                        and '.AppleDouble' not in dir and not file.startswith('.')):
-                    full_file = os.path.join(dir, file)
-                    mod_tm = os.path.getmtime(full_file)
-                    found = self.__db.execute(sql_select, (base, extension.lstrip("."), dir, mod_tm)).fetchone()
-                    if not found:
-                        out_of_date_files.append(full_file)
+            if not self.__keep_looping:
+                return out_of_date_files
+            if '.AppleDouble' in dir:  # have to filter out all the Apple junk
+                continue
+            db_files = {(row['basename'], row['extension']): row['last_modified']
+                        for row in self.__db.execute(sql_select, (dir,))}
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        base, extension = os.path.splitext(entry.name)
+                        if extension.lower() not in ImageCache.EXTENSIONS or entry.name.startswith('.'):
+                            continue
+                        try:
+                            mod_tm = entry.stat().st_mtime
+                        except OSError:
+                            continue
+                        last_modified = db_files.get((base, extension.lstrip(".")))
+                        if last_modified is None or last_modified < mod_tm:
+                            out_of_date_files.append(entry.path)
+            except OSError as e:
+                self.__logger.warning("Can't read folder %s -> %s", dir, e)
         return out_of_date_files
 
-    def __insert_file(self, file, file_id=None):
-        file_insert = "INSERT OR REPLACE INTO file(folder_id, basename, extension, last_modified) VALUES((SELECT folder_id from folder where name = ?), ?, ?, ?)"  # noqa: E501
-        file_update = "UPDATE file SET folder_id = (SELECT folder_id from folder where name = ?), basename = ?, extension = ?, last_modified = ? WHERE file_id = ?"  # noqa: E501
-        # Insert the new folder if it's not already in the table. Update the missing field separately.
+    def __insert_files(self):
+        batch = []
+        while self.__modified_files and not self.__pause_looping and self.__keep_looping:
+            file = self.__modified_files.pop(0)
+            self.__logger.debug('Inserting: %s', file)
+            try:
+                batch.append(ImageCache.read_file_meta(file))
+            except Exception as e:
+                self.__logger.warning("Can't read meta data of %s -> %s", file, e)
+            if len(batch) >= ImageCache.INSERT_BATCH_SIZE:
+                self.__write_files(batch)
+                batch = []
+        if batch:
+            self.__write_files(batch)
+
+    def __insert_files_parallel(self):
+        # The meta data of up to two files per worker is read in the pool while this thread
+        # is the only one writing the results to the db. Nothing new is submitted once looping is
+        # paused or stopped, files still in flight are finished and written, the rest stay in
+        # __modified_files for the next pass
+        pending = {}
+        batch = []
+        while self.__modified_files or pending:
+            while (self.__modified_files and len(pending) < 2 * self.__metadata_workers
+                   and not self.__pause_looping and self.__keep_looping):
+                file = self.__modified_files.pop(0)
+                pending[self.__executor.submit(ImageCache.read_file_meta, file)] = file
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file = pending.pop(future)
+                try:
+                    batch.append(future.result())
+                    self.__logger.debug('Inserting: %s', file)
+                except Exception as e:
+                    self.__logger.warning("Can't read meta data of %s -> %s", file, e)
+            if len(batch) >= ImageCache.INSERT_BATCH_SIZE:
+                self.__write_files(batch)
+                batch = []
+        if batch:
+            self.__write_files(batch)
+
+    def __write_files(self, batch):
+        # batch is a list of (file, last_modified, meta) tuples as returned by ImageCache.read_file_meta()
+        self.__prefetched_rows = {}  # might be out of date now
+        # The whole batch is written in one transaction and committed, so an interrupted scan only
+        # loses the current batch. folder_id is resolved once per folder and file_id through the
+        # UNIQUE(folder_id, basename, extension) index rather than searching the all_data view by fname.
+        # The upsert keeps file_id (and the display statistics) of files that changed on disk
         folder_insert = "INSERT OR IGNORE INTO folder(name) VALUES(?)"
-        folder_update = "UPDATE folder SET missing = 0 where name = ?"
-
-        mod_tm = os.path.getmtime(file)
-        dir, file_only = os.path.split(file)
-        base, extension = os.path.splitext(file_only)
-
-        # Get the file's meta info and build the INSERT statement dynamically
-        meta = self.__get_exif_info(file)
-        meta_insert = self.__get_meta_sql_from_dict(meta)
-        vals = list(meta.values())
-        vals.insert(0, file)
+        folder_select = "SELECT folder_id FROM folder WHERE name = ?"
+        folder_update = "UPDATE folder SET missing = 0 WHERE folder_id = ?"
+        file_upsert = """
+            INSERT INTO file(folder_id, basename, extension, last_modified) VALUES(?, ?, ?, ?)
+            ON CONFLICT(folder_id, basename, extension) DO UPDATE SET last_modified = excluded.last_modified"""
+        columns = list(batch[0][2].keys())  # the same keys in the same order for every file
+        meta_insert = """
+            INSERT OR REPLACE INTO meta(file_id, {0})
+            VALUES((SELECT file_id FROM file WHERE folder_id = ? AND basename = ? AND extension = ?), {1})
+            """.format(', '.join(columns), ', '.join('?' * len(columns)))
 
-        # Insert this file's info into the folder, file, and meta tables
         self.__db_write_lock.acquire()
-        self.__db.execute(folder_insert, (dir,))
-        self.__db.execute(folder_update, (dir,))
-        if file_id is None:
-            self.__db.execute(file_insert, (dir, base, extension.lstrip("."), mod_tm))
-        else:
-            self.__db.execute(file_update, (dir, base, extension.lstrip("."), mod_tm, file_id))
+        self.__db.execute("SAVEPOINT write_files")  # so a failure only undoes this batch
         try:
-            self.__db.execute(meta_insert, vals)
-        except:
-            self.__logger.error(f"###FAILED meta_insert = {meta_insert}, vals = {vals}")
-        self.__db_write_lock.release()
+            folder_ids = {}
+            files = []
+            metas = []
+            for file, mod_tm, meta in batch:
+                dir, file_only = os.path.split(file)
+                base, extension = os.path.splitext(file_only)
+                if dir not in folder_ids:
+                    cursor = self.__db.execute(folder_insert, (dir,))
+                    if cursor.rowcount == 1:
+                        folder_ids[dir] = cursor.lastrowid
+                    else:
+                        folder_ids[dir] = self.__db.execute(folder_select, (dir,)).fetchone()[0]
+                key = (folder_ids[dir], base, extension.lstrip("."))
+                files.append(key + (mod_tm,))
+                metas.append(key + tuple(meta[col] for col in columns))
+            self.__db.executemany(folder_update, [(folder_id,) for folder_id in folder_ids.values()])
+            self.__db.executemany(file_upsert, files)
+            self.__db.executemany(meta_insert, metas)
+            self.__db.execute("RELEASE write_files")
+            self.__db.commit()
+            batch = []
+        except Exception as e:
+            try:  # not rollback(), which would lose anything else not committed yet on this connection
+                self.__db.execute("ROLLBACK TO write_files")
+                self.__db.execute("RELEASE write_files")
+            except sqlite3.Error:  # the whole transaction has already been rolled back by sqlite
+                pass
+            if len(batch) == 1:
+                self.__logger.error("###FAILED to write %s to the db -> %s", batch[0][0], e)
+                batch = []
+        finally:
+            self.__db_write_lock.release()
+        for item in batch:  # only if writing the batch failed, find the culprit by writing one file at a time
+            self.__write_files([item])
 
     def __update_folder_info(self, folder_collection):
         update_data = []
-        sql = "UPDATE folder SET last_modified = ?, missing = 0 WHERE name = ?"
+        # folders without images get a row as well so they aren't out of date on every pass
+        sql = """
+            INSERT INTO folder(name, last_modified, subfolders) VALUES(?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                last_modified = excluded.last_modified, missing = 0, subfolders = excluded.subfolders"""
+        sql_subfolders = "UPDATE folder SET subfolders = ? WHERE name = ?"
         for folder, modtime in folder_collection:
             if not self.__keep_looping:
-                return out_of_date_folders
-            update_data.append((modtime, folder))
+                return
+            update_data.append((folder, modtime, self.__folder_children.pop(folder, None)))
+        # unchanged folders that were listed anyway, i.e. the first time with this schema or full scans
+        subfolder_data = [(subfolders, folder) for folder, subfolders in self.__folder_children.items()]
+        self.__folder_children = {}
         self.__db_write_lock.acquire()
         self.__db.executemany(sql, update_data)
+        self.__db.executemany(sql_subfolders, subfolder_data)
         self.__db_write_lock.release()
 
-    def __get_meta_sql_from_dict(self, dict):
-        columns = ', '.join(dict.keys())
-        ques = ', '.join('?' * len(dict.keys()))
-        return 'INSERT OR REPLACE INTO meta(file_id, {0}) VALUES((SELECT file_id from all_data where fname = ?), {1})'.format(columns, ques)  # noqa: E501
-
     def __purge_missing_files_and_folders(self):
         # Find folders in the db that are no longer on disk
         folder_id_list = []
@@ -504,7 +960,14 @@ class ImageCache:
                 self.__db_write_lock.release()
             self.__purge_files = False
 
-    def __get_exif_info(self, file_path_name):
+    @staticmethod
+    def read_file_meta(file):
+        """Returns (file, last_modified, meta), static so it can be run in a worker thread or process."""
+        mod_tm = os.path.getmtime(file)
+        return (file, mod_tm, ImageCache.get_exif_info(file))
+
+    @staticmethod
+    def get_exif_info(file_path_name):
         exifs = get_image_meta.GetImageMeta(file_path_name)
         # Dict to store interesting EXIF data
         # Note, the 'key' must match a field in the 'meta' table
@@ -3,13 +3,15 @@ import os
 import time
 import logging
 import locale
-import random
+import collections
+import numpy as np
+from typing import NamedTuple
 
 
 # Add the root directory to sys.path
 #sys.path.append(str(Path(__file__).resolve().parent.parent))
 
-from picframe import geo_reverse, image_cache, image_synology
+from picframe import geo_reverse, image_cache, image_synology, playlist
 
 DEFAULT_CONFIGFILE = "~/picframe_data/config/configuration.yaml"
 DEFAULT_CONFIG = {
@@ -60,6 +62,12 @@ DEFAULT_CONFIG = {
         'menu_text_sz': 40,
         'menu_autohide_tm': 10.0,
         'geo_suppress_list': [],
+        'prefetch_depth': 1,
+        'frame_cache': False,
+        'frame_cache_dir': '~/picframe_data/frame_cache',
+        'frame_cache_size': 500,
+        'frame_cache_format': 'jpeg',
+        'frame_cache_warmup': 0,
     },
     'model': {
 
@@ -72,6 +80,9 @@ DEFAULT_CONFIG = {
         'time_delay': 200.0,
         'fade_time': 10.0,
         'shuffle': True,
+        'shuffle_seed': None,
+        'weighted_selection': False,
+        'rating_weight': 0.0,
         'sort_cols': 'fname ASC',
         'image_attr': ['PICFRAME GPS'],  # image attributes send by MQTT, Keys are taken from exifread library, 'PICFRAME GPS' is special to retrieve GPS lon/lat # noqa: E501
         'load_geoloc': True,
@@ -82,10 +93,19 @@ DEFAULT_CONFIG = {
                      ['region', 'state', 'province'],
                      ['country']],
         'geo_key': 'this_needs_to@be_changed',  # use your email address
+        'geo_cell_size': 0.001,
+        'geo_rate_limit': 1.0,
+        'geo_gazetteer': '',
         'db_file': '~/picframe_data/data/pictureframe.db3',
         'portrait_pairs': False,
+        'portrait_pairs_by': None,
         'deleted_pictures': '~/DeletedPictures',
         'update_interval': 2.0,
+        'metadata_workers': 1,
+        'metadata_pool': 'thread',
+        'watch_mode': 'poll',
+        'prune_folders': False,
+        'full_scan_interval': 86400,
         'log_level': 'WARNING',
         'log_file': '',
         'location_filter': '',
@@ -125,39 +145,38 @@ DEFAULT_CONFIG = {
 }
 
 
-class Pic:  # TODO could this be done more elegantly with namedtuple
-
-    def __init__(self, fname, last_modified, file_id, orientation=1, exif_datetime=0,
-                 f_number=0, exposure_time=None, iso=0, focal_length=None,
-                 make=None, model=None, lens=None, rating=None, latitude=None,
-                 longitude=None, width=0, height=0, is_portrait=0, location=None, title=None,
-                 caption=None, tags=None):
-        self.fname = fname
-        self.last_modified = last_modified
-        self.file_id = file_id
-        self.orientation = orientation
-        self.exif_datetime = exif_datetime
-        self.f_number = f_number
-        self.exposure_time = exposure_time
-        self.iso = iso
-        self.focal_length = focal_length
-        self.make = make
-        self.model = model
-        self.lens = lens
-        self.rating = rating
-        self.latitude = latitude
-        self.longitude = longitude
-        self.width = width
-        self.height = height
-        self.is_portrait = is_portrait
-        self.location = location
-        self.tags = tags
-        self.caption = caption
-        self.title = title
+class Pic(NamedTuple):
+    """A row of the all_data view, or an album file, with the fields read by name i.e. pic.fname"""
+    fname: str
+    last_modified: float
+    file_id: int
+    orientation: int = 1
+    exif_datetime: float = 0
+    f_number: float = 0
+    exposure_time: str = None
+    iso: float = 0
+    focal_length: str = None
+    make: str = None
+    model: str = None
+    lens: str = None
+    rating: int = None
+    latitude: float = None
+    longitude: float = None
+    width: int = 0
+    height: int = 0
+    is_portrait: int = 0
+    location: str = None
+    title: str = None
+    caption: str = None
+    tags: str = None
+    folder_name: str = None
 
 
 class Model:
 
+    WEIGHT_MAX_AGE = 365 * 24 * 3600.0  # seconds since last shown after which files are weighted the same
+    WEIGHTED_HISTORY = 100  # number of weighted picks kept to go back through
+
     def __init__(self, configfile=DEFAULT_CONFIGFILE):
         self.__logger = logging.getLogger("model.Model")
         self.__logger.debug('creating an instance of Model')
@@ -186,8 +205,14 @@ class Model:
                     root_logger.removeHandler(hdlr)
             root_logger.addHandler(filehandler)      # set the new handler
 
-        self.__file_list = []  # this is now a list of tuples i.e (file_id1,) or (file_id1, file_id2)
+        self.__file_list = []  # Playlist of tuples i.e (file_id1,) or (file_id1, file_id2), int64 array for albums
         self.__number_of_files = 0  # this is shortcut for len(__file_list)
+        self.__where_clause = None  # used for the current __file_list
+        self.__max_file_id = 0  # files added to the db after __file_list was loaded have higher file_ids
+        self.__new_files_tm = 0.0  # time to check for them
+        self.__sampler = None  # WeightedSampler over __file_list with weighted_selection
+        self.__weighted_picks = collections.deque()  # indices of __file_list drawn by __sampler to show next
+        self.__weighted_shown = collections.deque(maxlen=Model.WEIGHTED_HISTORY)  # and those shown, to go back
         self.__reload_files = True
         self.__file_index = 0  # pointer to next position in __file_list
         self.__file_index = 0  # pointer to next position in __file_list
@@ -203,14 +228,33 @@ class Model:
         self.__pic_dir = os.path.expanduser(model_config['pic_dir'])
         self.__subdirectory = os.path.expanduser(model_config['subdirectory'])
         self.__load_geoloc = model_config['load_geoloc']
-        self.__geo_reverse = geo_reverse.GeoReverse(model_config['geo_key'],
-                                                    key_list=self.get_model_config()['key_list'])
+        self.__rng = np.random.default_rng(model_config['shuffle_seed'])  # shuffles the playlist
+        self.__geo_reverse = None  # and ImageCache won't look up any locations
+        geo_rate_limit = model_config['geo_rate_limit']
+        if self.__load_geoloc and model_config['geo_gazetteer']:
+            try:
+                self.__geo_reverse = geo_reverse.LocalGeoReverse(os.path.expanduser(model_config['geo_gazetteer']))
+                geo_rate_limit = 0.0  # no requests to ration
+            except (OSError, ValueError) as e:
+                self.__logger.error("Can't load geo_gazetteer %s, using Nominatim -> %s",
+                                    model_config['geo_gazetteer'], e)
+        if self.__load_geoloc and self.__geo_reverse is None:
+            self.__geo_reverse = geo_reverse.GeoReverse(model_config['geo_key'],
+                                                        key_list=self.get_model_config()['key_list'],
+                                                        cell_size=model_config['geo_cell_size'])
         self.__image_cache = image_cache.ImageCache(self.__pic_dir,
                                                     model_config['follow_links'],
                                                     os.path.expanduser(model_config['db_file']),
                                                     self.__geo_reverse,
                                                     int(model_config['update_interval']),
-                                                    model_config['portrait_pairs'])
+                                                    model_config['portrait_pairs'],
+                                                    model_config['metadata_workers'],
+                                                    model_config['metadata_pool'],
+                                                    model_config['watch_mode'],
+                                                    model_config['prune_folders'],
+                                                    model_config['full_scan_interval'],
+                                                    geo_rate_limit,
+                                                    model_config['portrait_pairs_by'])
 
 
         self.__deleted_pictures = model_config['deleted_pictures']
@@ -424,16 +468,32 @@ class Model:
             s_upper = s.upper()
             if s_upper in tokens:
                 if s_upper in ("AND", "OR"):
-                    if last_token in ("AND", "OR"):
-                        return None  # must have a non-token between
-                    last_token = s_upper
-                filter.append(s)
+                    if last_token in ("AND", "OR", "NOT", "(", ""):
+                        self.__logger.error("%s filter '%s' needs a phrase before %s", field, val, s_upper)
+                        return None
+                elif s_upper == ")":
+                    if last_token in ("AND", "OR", "NOT", "("):
+                        self.__logger.error("%s filter '%s' needs a phrase before )", field, val)
+                        return None
+                elif last_token in (None, ")"):
+                    filter.append("AND")  # "a NOT b" and "a (b)" mean a AND ...
+                last_token = s_upper
+                filter.append(s_upper)
             else:
-                if last_token is not None:
-                    filter.append("{} LIKE '%{}%'".format(field, s))
+                if filter and isinstance(filter[-1], list):
+                    filter[-1].append(s)  # consecutive words are one phrase
                 else:
-                    filter[-1] = filter[-1].replace("%'", " {}%'".format(s))
+                    if last_token == ")":
+                        filter.append("AND")
+                    filter.append([s])
                 last_token = None
+        if last_token in ("AND", "OR", "NOT"):
+            self.__logger.error("%s filter '%s' can't end with %s", field, val, last_token)
+            return None
+        # each phrase is looked up in the meta_fts full text index, matching words starting with it.
+        # AND, OR, NOT and brackets stay as SQL so NOT works on its own, which fts5 doesn't allow
+        filter = ["file_id IN (SELECT rowid FROM meta_fts WHERE meta_fts MATCH '{} : \"{}\"*')".format(
+                  field, " ".join(item)) if isinstance(item, list) else item for item in filter]
         return "({})".format(" ".join(filter))  # if OR outside brackets will modify the logic of rest of where clauses
 
     def set_where_clause(self, key, value=None):
@@ -484,6 +544,13 @@ class Model:
         self.__reload_files = True
 
     def set_next_file_to_previous_file(self):
+        if self.__sampler is not None and self.__useAlbum == False:
+            # like the sequential playlist show the previous one next, then the current one again. Each
+            # step back takes the last one off __weighted_shown so pressing back again goes further back
+            if len(self.__weighted_shown) >= 2:
+                self.__weighted_picks.appendleft(self.__weighted_shown.pop())
+                self.__weighted_picks.appendleft(self.__weighted_shown.pop())
+            return
         self.__file_index = (self.__file_index - 2) % self.__number_of_files  # TODO deleting last image results in ZeroDivisionError # noqa: E501
 
     def refresh_album_list(self):
@@ -501,6 +568,10 @@ class Model:
             pic2 = None
             self.__logger.info('Get next file')
 
+            if (not self.__reload_files and self.shuffle and self.__useAlbum == False and self.__sampler is None
+                    and time.time() > self.__new_files_tm):
+                self.__add_new_files()
+
             # Reload the playlist if requested
             if self.__reload_files:
                 for _i in range(5):  # give image_cache chance on first load if a large directory
@@ -533,7 +604,15 @@ class Model:
             
             #TODONEW
             if self.__useAlbum == False:
-                file_ids = self.__file_list[self.__file_index]
+                index = self.__file_index
+                if self.__sampler is not None:
+                    self.__pick_weighted(1)
+                    if not self.__weighted_picks:  # all shown, reload to weight them by the new display stats
+                        self.__reload_files = True
+                        continue
+                    index = self.__weighted_picks.popleft()
+                    self.__weighted_shown.append(index)
+                file_ids = self.__file_list[index]
                 pic_row = self.__image_cache.get_file_info(file_ids[0])
                 pic1 = Pic(**pic_row) if pic_row is not None else None
 
@@ -554,16 +633,7 @@ class Model:
             else:
                 file_id = self.__file_list[self.__file_index]
                 self.__logger.info('Get file from album')
-                pic_row = self.__image_synology.get_file_info(file_id)
-                firstPart = os.path.normpath(pic_row['fname']).split(os.sep)[0]
-                remaining_path = os.path.normpath(pic_row['fname']).split(os.sep)[1:]
-                remaining_path = os.path.join(*remaining_path)
-                if firstPart == 'shared':
-                    pic_row['fname'] = os.path.join(self.__pic_dir, remaining_path)
-                else:
-                    pic_row['fname'] = os.path.join(self.__pic_mine_dir, remaining_path)
-                self.__logger.info(pic_row)
-                pic1 = Pic(**pic_row) if pic_row is not None else None
+                pic1 = self.__get_album_pic(file_id)
 
             # Increment the image index for next time
             self.__file_index += 1
@@ -579,7 +649,57 @@ class Model:
         self.__current_pics = (pic1, pic2)
         return self.__current_pics
 
+    def get_upcoming_pics(self, n):
+        """Returns up to n (pic1, pic2) tuples which get_next_file() is expected to return next
+        without moving on or counting them as displayed, so the viewer can prepare them in advance.
+        Nothing is returned if the playlist is about to be reloaded or reshuffled.
+        """
+        upcoming = []
+        if self.__reload_files:
+            return upcoming
+        if self.__sampler is not None and self.__useAlbum == False:
+            self.__pick_weighted(n)
+            indices = list(self.__weighted_picks)[:n]
+        else:
+            indices = range(self.__file_index, min(self.__file_index + n, self.__number_of_files))
+        if self.__useAlbum == False:
+            # one query for all of them, which get_next_file() then uses as well
+            file_ids = [self.__file_list[i] for i in indices]
+            rows = iter(self.__image_cache.get_file_infos([file_id for ids in file_ids for file_id in ids]))
+            for ids in file_ids:
+                pics = [None, None]
+                for j in range(len(ids)):
+                    pic_row = next(rows)
+                    pics[j] = Pic(**pic_row) if pic_row is not None else None
+                if pics[0] is None:
+                    pics = [pics[1], None]
+                if pics[0] is not None:
+                    upcoming.append(tuple(pics))
+        else:
+            for i in indices:
+                pic = self.__get_album_pic(self.__file_list[i])
+                if pic is not None:
+                    upcoming.append((pic, None))
+        return upcoming
+
+    def __get_album_pic(self, file_id):
+        pic_row = self.__image_synology.get_file_info(file_id)
+        if not pic_row:
+            return None
+        pic_row = dict(pic_row)  # don't change the stored fname, this is called more than once per file
+        firstPart = os.path.normpath(pic_row['fname']).split(os.sep)[0]
+        remaining_path = os.path.normpath(pic_row['fname']).split(os.sep)[1:]
+        remaining_path = os.path.join(*remaining_path)
+        if firstPart == 'shared':
+            pic_row['fname'] = os.path.join(self.__pic_dir, remaining_path)
+        else:
+            pic_row['fname'] = os.path.join(self.__pic_mine_dir, remaining_path)
+        self.__logger.info(pic_row)
+        return Pic(**pic_row)
+
     def get_number_of_files(self):
+        if self.__useAlbum == True:
+            return len(self.__file_list)  # ids not tuples
         return sum(
                     sum(1 for pic in pics if pic is not None)
                     for pics in self.__file_list
@@ -601,11 +721,19 @@ class Model:
             os.system("mkdir {}".format(move_to_dir))  # problems with ownership using python func
         os.system("mv '{}' '{}'".format(f_to_delete, move_to_dir))  # and with SMB drives
         # find and delete record from __file_list
-        for i, file_rec in enumerate(self.__file_list):
-            if file_rec[0] == pic.file_id:  # database id TODO check that db tidies itself up
-                self.__file_list.pop(i)
+        if self.__useAlbum == True:  # an int64 array of album ids
+            (positions,) = np.nonzero(self.__file_list == pic.file_id)
+            if len(positions) > 0:
+                self.__file_list = np.delete(self.__file_list, positions[0])
                 self.__number_of_files -= 1
-                break
+        else:
+            for i, file_rec in enumerate(self.__file_list):
+                if file_rec[0] == pic.file_id:  # database id TODO check that db tidies itself up
+                    self.__file_list.pop(i)
+                    self.__number_of_files -= 1
+                    break
+        if self.__sampler is not None:
+            self.__reload_files = True  # the sampler's indices have moved
 
     def __get_files(self):
         if self.__useAlbum == False:
@@ -613,7 +741,10 @@ class Model:
                 picture_dir = os.path.join(self.__pic_dir, self.subdirectory)  # TODO catch, if subdirecotry does not exist
             else:
                 picture_dir = self.__pic_dir
-            where_list = ["fname LIKE '{}/%'".format(picture_dir)]  # TODO / on end to stop 'test' also selecting test1 test2 etc  # noqa: E501
+            # the folder and its subfolders as an index range, '0' is the character after '/'
+            picture_dir = picture_dir.rstrip(os.sep).replace("'", "''")
+            where_list = ["(folder_name = '{0}' OR (folder_name >= '{0}/' AND folder_name < '{0}0'))".format(
+                          picture_dir)]
             where_list.extend(self.__where_clauses.values())
 
             if len(where_list) > 0:
@@ -621,14 +752,26 @@ class Model:
             else:
                 where_clause = "1"
 
-            sort_list = []
             recent_n = self.get_model_config()["recent_n"]
-            if recent_n > 0:
-                sort_list.append("last_modified < {:.0f}".format(time.time() - 3600 * 24 * recent_n))
+            recent_tm = time.time() - 3600 * 24 * recent_n
 
             if self.shuffle:
-                sort_list.append("RANDOM()")
+                # shuffled here with the seeded __rng rather than by ORDER BY RANDOM() in sqlite. Portrait pairs
+                # are made up in file_id order and then shuffled as one entry, so the same seed gives the same list
+                if recent_n > 0:  # shuffle the recent files and put them first
+                    where_list = ["({}) AND last_modified >= {:.0f}".format(where_clause, recent_tm),
+                                  "({}) AND last_modified < {:.0f}".format(where_clause, recent_tm)]
+                else:
+                    where_list = [where_clause]
+                self.__file_list = playlist.Playlist()
+                for group_clause in where_list:
+                    start = len(self.__file_list)
+                    self.__file_list.extend(self.__image_cache.query_cache(group_clause, "file_id"))
+                    self.__file_list.shuffle(self.__rng, start)
             else:
+                sort_list = []
+                if recent_n > 0:
+                    sort_list.append("last_modified < {:.0f}".format(recent_tm))
                 if self.__col_names is None:
                     self.__col_names = self.__image_cache.get_column_names()  # do this once
                 for col in self.__sort_cols.split(","):
@@ -636,10 +779,17 @@ class Model:
                     if colsplit[0] in self.__col_names and (len(colsplit) == 1 or colsplit[1].upper() in ("ASC", "DESC")):
                         sort_list.append(col)
                 sort_list.append("fname ASC")  # always finally sort on this in case nothing else to sort on or sort_cols is "" # noqa: E501
-            sort_clause = ",".join(sort_list)
-
-            self.__file_list = self.__image_cache.query_cache(where_clause, sort_clause)
+                sort_clause = ",".join(sort_list)
+                self.__file_list = playlist.Playlist(self.__image_cache.query_cache(where_clause, sort_clause))
             self.__number_of_files = len(self.__file_list)
+            self.__where_clause = where_clause
+            self.__max_file_id = self.__file_list.max_id()
+            self.__new_files_tm = time.time() + self.get_model_config()['update_interval']
+            self.__sampler = None
+            if self.get_model_config()['weighted_selection']:
+                self.__sampler = playlist.WeightedSampler(self.__selection_weights())
+            self.__weighted_picks.clear()
+            self.__weighted_shown.clear()
 
             self.__file_index = 0
             self.__num_run_through = 0
@@ -648,10 +798,13 @@ class Model:
         elif self.useMineAlbum == True:
             if self.__mineAlbumName != '':
                 
-                self.__file_list = self.__image_synology.get_file_list()
+                self.__file_list = self.__image_synology.get_file_list()  # int64 array of the album ids
                 if self.shuffle:
-                    random.shuffle(self.__file_list)
+                    self.__rng.shuffle(self.__file_list)
                 self.__number_of_files = len(self.__file_list)
+                self.__sampler = None  # weighted_selection only weights the image cache playlist
+                self.__weighted_picks.clear()
+                self.__weighted_shown.clear()
                 self.__file_index = 0
                 self.__num_run_through = 0
                 self.__reload_files = False
@@ -660,10 +813,13 @@ class Model:
                 self.__reload_files = False
         else:
             if self.__albumName != '':
-                self.__file_list = self.__image_synology.get_file_list()
+                self.__file_list = self.__image_synology.get_file_list()  # int64 array of the album ids
                 if self.shuffle:
-                    random.shuffle(self.__file_list)
+                    self.__rng.shuffle(self.__file_list)
                 self.__number_of_files = len(self.__file_list)
+                self.__sampler = None
+                self.__weighted_picks.clear()
+                self.__weighted_shown.clear()
                 self.__file_index = 0
                 self.__num_run_through = 0
                 self.__reload_files = False
@@ -671,6 +827,46 @@ class Model:
                 self.__useAlbum = False
                 self.__reload_files = False  
 
+    def __selection_weights(self):
+        # time since each entry in __file_list was last shown, up to WEIGHT_MAX_AGE, times 1 + rating_weight * rating
+        rows = self.__image_cache.get_display_stats(self.__where_clause)
+        rating_weight = self.get_model_config()['rating_weight']
+        file_ids = self.__file_list.first_ids()
+        last_displayed = np.zeros(len(file_ids))
+        rating = np.zeros(len(file_ids))
+        if rows:  # looked up by a binary search of the stats sorted by file_id
+            stats_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            order = np.argsort(stats_ids)
+            stats_ids = stats_ids[order]
+            positions = np.minimum(np.searchsorted(stats_ids, file_ids), len(rows) - 1)
+            found = stats_ids[positions] == file_ids
+            stats_last = np.fromiter((row[1] or 0.0 for row in rows), dtype=np.float64, count=len(rows))[order]
+            stats_rating = np.fromiter((row[2] or 0 for row in rows), dtype=np.float64, count=len(rows))[order]
+            last_displayed[found] = stats_last[positions[found]]
+            rating[found] = stats_rating[positions[found]]
+        age = np.clip(time.time() - last_displayed, 1.0, Model.WEIGHT_MAX_AGE)  # never 0 so a pass always finishes
+        return age * (1.0 + rating_weight * np.maximum(rating, 0.0))
+
+    def __pick_weighted(self, n):
+        # draw until n picks are waiting, each one weighted 0 afterwards so it's shown once per pass
+        while len(self.__weighted_picks) < n:
+            index = self.__sampler.sample(self.__rng)
+            if index is None:
+                break
+            self.__sampler.update(index, 0.0)
+            self.__weighted_picks.append(index)
+
+    def __add_new_files(self):
+        # slot files the image cache has found since __get_files() into the part of the playlist not shown yet
+        self.__new_files_tm = time.time() + self.get_model_config()['update_interval']
+        new_files = self.__image_cache.query_cache(
+            "({}) AND file_id > {}".format(self.__where_clause, self.__max_file_id), "file_id")
+        if new_files:
+            self.__logger.info("Adding %d new files to the playlist", len(new_files))
+            self.__file_list.insert_random(new_files, self.__rng, self.__file_index)
+            self.__number_of_files = len(self.__file_list)
+            self.__max_file_id = self.__file_list.max_id()
+
     def __updateAlbumToUse(self):
         if self.__useMineAlbum == True:
             self.__image_synology.set_albumName(self.__mineAlbumName)
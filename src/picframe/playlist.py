@@ -0,0 +1,137 @@
+import numpy as np
+
+
+class Playlist:
+    """The file_ids of the slideshow held in an int64 numpy array rather than a list of tuples.
+
+    Each entry is one file or a portrait pair and reads back as the tuple (file_id,) or
+    (file_id1, file_id2) like the rows returned by ImageCache.query_cache(). Single entries
+    have 0 as the second id, which sqlite never uses as a rowid.
+    """
+
+    def __init__(self, entries=()):
+        self.__ids = np.zeros((max(len(entries), 16), 2), dtype=np.int64)  # spare capacity to add to
+        self.__len = 0
+        self.extend(entries)
+
+    def __len__(self):
+        return self.__len
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.__len
+        if not 0 <= i < self.__len:
+            raise IndexError("playlist index out of range")
+        file_id1, file_id2 = self.__ids[i]
+        return (int(file_id1),) if file_id2 == 0 else (int(file_id1), int(file_id2))
+
+    def __iter__(self):
+        for i in range(self.__len):
+            yield self[i]
+
+    def __reserve(self, n):
+        if self.__len + n > len(self.__ids):
+            ids = np.zeros((max(2 * len(self.__ids), self.__len + n), 2), dtype=np.int64)
+            ids[:self.__len] = self.__ids[:self.__len]
+            self.__ids = ids
+
+    @staticmethod
+    def __to_array(entries):
+        ids = np.zeros((len(entries), 2), dtype=np.int64)
+        ids[:, 0] = np.fromiter((entry[0] for entry in entries), dtype=np.int64, count=len(entries))
+        ids[:, 1] = np.fromiter((entry[1] if len(entry) > 1 else 0 for entry in entries),
+                                dtype=np.int64, count=len(entries))
+        return ids
+
+    def extend(self, entries):
+        self.__reserve(len(entries))
+        self.__ids[self.__len:self.__len + len(entries)] = Playlist.__to_array(entries)
+        self.__len += len(entries)
+
+    def insert_random(self, entries, rng, start=0):
+        """Put the entries at random positions from start onwards, i.e. among those not shown yet."""
+        if not entries:
+            return
+        positions = np.sort(rng.integers(start, self.__len, size=len(entries), endpoint=True))
+        ids = np.insert(self.__ids[:self.__len], positions, Playlist.__to_array(entries), axis=0)
+        self.__len = len(ids)
+        self.__ids = ids
+
+    def pop(self, i):
+        entry = self[i]
+        self.__ids[i:self.__len - 1] = self.__ids[i + 1:self.__len]
+        self.__len -= 1
+        return entry
+
+    def shuffle(self, rng, start=0, end=None):
+        """Shuffle the entries from start to end in place using rng, a numpy Generator."""
+        end = self.__len if end is None else min(end, self.__len)
+        # a permutation index is much quicker than rng.shuffle() swapping rows of a 2D array one by one
+        self.__ids[start:end] = self.__ids[start:end][rng.permutation(end - start)]
+
+    def first_ids(self):
+        """The first file_id of each entry as an int64 array, a view that changes with the playlist."""
+        return self.__ids[:self.__len, 0]
+
+    def max_id(self):
+        return int(self.__ids[:self.__len].max()) if self.__len else 0
+
+
+class WeightedSampler:
+    """Picks indices 0..n-1 with a probability proportional to their weight. The weights are held
+    in a Fenwick (binary indexed) tree so picking and changing a weight are both O(log n).
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        self.__n = len(weights)
+        # tree[i] is the sum of the lowbit(i) weights ending at i (1 based), built from the cumulative sum
+        prefix = np.concatenate(([0.0], np.cumsum(weights)))
+        i = np.arange(1, self.__n + 1)
+        tree = np.zeros(self.__n + 1)
+        tree[1:] = prefix[i] - prefix[i - (i & -i)]
+        self.__tree = tree.tolist()  # python floats are quicker than numpy scalars one at a time
+        self.__weights = weights.tolist()
+        self.__top_bit = 1 << (self.__n.bit_length() - 1) if self.__n else 0
+
+    def __len__(self):
+        return self.__n
+
+    @property
+    def total(self):
+        total = 0.0
+        i = self.__n
+        while i > 0:
+            total += self.__tree[i]
+            i -= i & -i
+        return total
+
+    def get(self, index):
+        return self.__weights[index]
+
+    def update(self, index, weight):
+        delta = weight - self.__weights[index]
+        self.__weights[index] = weight
+        i = index + 1
+        while i <= self.__n:
+            self.__tree[i] += delta
+            i += i & -i
+
+    def sample(self, rng):
+        """Returns a random index or None if all the weights are 0."""
+        total = self.total
+        if total <= 0.0:
+            return None
+        target = rng.random() * total
+        pos = 0
+        step = self.__top_bit
+        while step:  # find the first index with the cumulative weight beyond target
+            nxt = pos + step
+            if nxt <= self.__n and self.__tree[nxt] <= target:
+                pos = nxt
+                target -= self.__tree[nxt]
+            step >>= 1
+        if pos >= self.__n or self.__weights[pos] <= 0.0:  # only from rounding errors, take any index left
+            positive = [i for i, weight in enumerate(self.__weights) if weight > 0.0]
+            return positive[int(rng.integers(len(positive)))] if positive else None
+        return pos
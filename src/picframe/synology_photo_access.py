@@ -1,14 +1,20 @@
 import os
+import collections
+import json
 import requests
 import configparser
 import logging
-import datetime
 import pickle
 import threading
 import time
 
+import numpy as np
+
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from picframe import synology_store
 
 # Suppress only the InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -33,6 +39,76 @@ DEFAULT_FILEINFO_FILE= "~/picframe_data/config/fileinfo.pkl"
 FOLDER_INFO = True
 FILE_INFO = False
 DEFAULT_CONFIGFILE = "~/picframe_data/config/config.ini"
+DEFAULT_STORE_FILE = "~/picframe_data/data/synology.db3"  # next to the image cache's pictureframe.db3
+
+POOL_SIZE = 8  # kept alive connections to the NAS, enough for the folder scan and the slideshow at once
+REQUEST_TIMEOUT = 30  # seconds
+API_INFO_ERRORS = (102, 103, 104)  # API, method or version not found i.e. the cached API info may be out of date
+FOLDER_PAGE_SIZE = 1000  # folders per SYNO.Foto.Browse.Folder list request
+FOLDER_CRAWL_WORKERS = 4  # folder list requests in flight at once, no more than POOL_SIZE
+ALBUM_PAGE_SIZE = 250  # album items per SYNO.Foto.Browse.Item request
+ALBUM_FETCH_WORKERS = 4  # album item requests in flight at once, no more than POOL_SIZE
+ALBUM_ADDITIONAL = '["orientation","address"]'  # the only additional item fields used by __file_entry()
+
+class AlbumIndex:
+    """The file info of an album held column wise in numpy arrays with the directories, captions and
+    locations, which many files share, stored once. ids is the album as an int64 array in album
+    order and get() finds the file info dict of an id with a dict lookup rather than a list search.
+    """
+
+    def __init__(self, files):
+        n = len(files)
+        self.ids = np.fromiter((int(info['file_id']) for info in files), dtype=np.int64, count=n)
+        self.__rows = {file_id: row for row, file_id in enumerate(self.ids.tolist())}
+        self.__basenames = [None] * n
+        self.__folder = np.zeros(n, dtype=np.int32)  # row in __folders
+        self.__exif_datetime = np.zeros(n)
+        self.__last_modified = np.zeros(n)
+        self.__orientation = np.zeros(n, dtype=np.int8)  # 0 if not known
+        self.__location = np.full(n, -1, dtype=np.int32)  # row in __locations or -1 if none
+        folder_rows = {}  # (directory of fname, caption) -> row
+        location_rows = {}
+        for row, info in enumerate(files):
+            directory, _, self.__basenames[row] = info['fname'].rpartition('/')
+            folder = (directory, info.get('caption'))
+            self.__folder[row] = folder_rows.setdefault(folder, len(folder_rows))
+            self.__exif_datetime[row] = info.get('exif_datetime') or 0.0
+            self.__last_modified[row] = info.get('last_modified') or 0.0
+            self.__orientation[row] = info.get('orientation') or 0
+            if info.get('location') is not None:
+                self.__location[row] = location_rows.setdefault(info['location'], len(location_rows))
+        self.__folders = list(folder_rows)  # dicts keep the order rows were added in
+        self.__locations = list(location_rows)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, file_id):
+        return self.get_row(file_id) is not None
+
+    def get_row(self, file_id):
+        try:
+            return self.__rows.get(int(file_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, file_id):
+        """Returns the file info dict of file_id or None if it isn't in the album."""
+        row = self.get_row(file_id)
+        if row is None:
+            return None
+        directory, caption = self.__folders[self.__folder[row]]
+        info = {'fname': directory + '/' + self.__basenames[row],
+                'exif_datetime': float(self.__exif_datetime[row]),
+                'last_modified': float(self.__last_modified[row]),
+                'caption': caption,
+                'file_id': int(self.ids[row])}
+        if self.__orientation[row]:
+            info['orientation'] = int(self.__orientation[row])
+        if self.__location[row] >= 0:
+            info['location'] = self.__locations[self.__location[row]]
+        return info
+
 
 class SynologyAccess():
     def __init__(self):
@@ -51,10 +127,18 @@ class SynologyAccess():
             quit()
 
         self.sid = None
+        self.session = self.__create_session()  # shared by all threads, requests' connection pool is thread safe
+        self.__api_info = None  # from get_api_info(), kept until a request fails with one of API_INFO_ERRORS
+        self.__api_info_lock = threading.Lock()
+        self.__timings = {}  # 'api.method' -> [number of requests, total seconds]
+        self.__timings_lock = threading.Lock()
 
         self.albumsInformation = {}
-        self.folderDict = self.load_dict_from_file(FOLDER_INFO)
-        self.fileInfoDict = self.load_dict_from_file(FILE_INFO)
+        self.__album_index = AlbumIndex([])  # files of the album last fetched by get_album()
+        self.__store = synology_store.SynologyStore(os.path.expanduser(DEFAULT_STORE_FILE))
+        if self.__store.is_empty():
+            self.import_pickle_files()
+        self.folderDict = self.__store.load_folders()
 
         self.mineId = 0
 
@@ -92,26 +176,14 @@ class SynologyAccess():
         with open(folderfile, 'rb') as file:
             return pickle.load(file)
 
-    def save_folderdict_to_file(self, fileType):
-        """
-        Save a dictionary to a file in Pickle format. Overwrites existing content.
-        
-        :param dictionary: Dictionary to save
-        :param file_path: Path to the file
-        """
-
-        if fileType == FOLDER_INFO:
-            filePath = DEFAULT_FOLDER_FILE
-        else:
-            filePath = DEFAULT_FILEINFO_FILE
-
-        folderfile = os.path.expanduser(filePath)
-        
-        with open(folderfile, 'wb') as file:
-            if fileType == FOLDER_INFO:
-                pickle.dump(self.folderDict, file)
-            else:
-                pickle.dump(self.fileInfoDict, file)
+    def import_pickle_files(self):
+        """Copies folder.pkl and fileinfo.pkl, where older versions kept the folders and albums, into the store."""
+        folders = self.load_dict_from_file(FOLDER_INFO)
+        if folders:
+            self.__store.save_folders(folders)
+        for album_name, album in self.load_dict_from_file(FILE_INFO).items():
+            self.__store.save_album(album_name, album['version'],
+                                    [album['fileInfo'][theId] for theId in album['fileIds']])
 
     def _run_periodic_task(self):
         """
@@ -139,14 +211,61 @@ class SynologyAccess():
         while not self.__shutdown_completed:
             time.sleep(0.05)  # make function blocking to ensure staged shutdown
         self.logout()
+        self.log_timing_report()
+        self.session.close()
+        self.__store.close()
+
+    def __create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.verify = False
+        session.headers.update({"Connection": "keep-alive"})
+        return session
+
+    def __get_api_path(self, api, refresh=False):
+        with self.__api_info_lock:
+            if self.__api_info is None or refresh or api not in self.__api_info:
+                self.__api_info = self.get_api_info()
+            return self.__api_info[api]['path']
+
+    def __record_timing(self, endpoint, seconds):
+        with self.__timings_lock:
+            timing = self.__timings.setdefault(endpoint, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+
+    def __request(self, api, params):
+        """GET api with params using the shared session and the cached API path. If the NAS replies
+        that the API, method or version doesn't exist the API info is fetched again and the request
+        repeated once. Returns the decoded JSON, raises requests.HTTPError for a HTTP error status."""
+        params = dict(params, api=api)
+        endpoint = "{}.{}".format(api, params.get("method"))
+        for attempt in range(2):
+            url = f"{self.url}/webapi/{self.__get_api_path(api, refresh=attempt > 0)}"
+            starttime = time.perf_counter()
+            response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            self.__record_timing(endpoint, time.perf_counter() - starttime)
+            response.raise_for_status()
+            data = response.json()
+            if data.get("success") or data.get("error", {}).get("code") not in API_INFO_ERRORS:
+                break
+            self.__logger.debug("%s failed with %s, refreshing API info", endpoint, data["error"])
+        return data
+
+    def timing_report(self):
+        """Returns {'api.method': (number of requests, total seconds, mean milliseconds)}"""
+        with self.__timings_lock:
+            return {endpoint: (count, total, 1000.0 * total / count)
+                    for endpoint, (count, total) in self.__timings.items()}
 
+    def log_timing_report(self):
+        for endpoint, (count, total, mean) in sorted(self.timing_report().items()):
+            self.__logger.info("%-40s %6d requests %8.2f s %8.1f ms each", endpoint, count, total, mean)
 
     def login(self):
-        self.session = requests.Session()
-        api_info = self.get_api_info()
-        self.auth_url = f"{self.url}/webapi/{api_info[AUTH_API]['path']}"
         params = {
-            "api": AUTH_API,
             "version": "6",
             "method": "login",
             "account": self.username,
@@ -157,14 +276,12 @@ class SynologyAccess():
         #if otp_code:
          #   params["otp_code"] = otp_code
 
-        response = self.session.get(self.auth_url, params=params, verify=False)
-
-        response.raise_for_status()
-        data = response.json()
+        data = self.__request(AUTH_API, params)
 
         if not data["success"]:
             self.__logger.error("Login failed")
         self.sid = data["data"]["sid"]
+        self.session.cookies.set("id", self.sid)
 
         self.__logger.debug("Login successful")
 
@@ -182,7 +299,9 @@ class SynologyAccess():
         headers = {
             "Accept": "application/json"
         }
-        response = self.session.get(url,headers=headers, params=params,  verify=False)
+        starttime = time.perf_counter()
+        response = self.session.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+        self.__record_timing(API_INFO + ".query", time.perf_counter() - starttime)
 
         try:
             response.raise_for_status()
@@ -196,35 +315,26 @@ class SynologyAccess():
             return
 
         params = {
-            "api": AUTH_API,
             "version": "6",
             "method": "logout",
             "session": "SynoPhotos"
         }
-        response = self.session.get(self.auth_url, params=params, verify=False)
-        response.raise_for_status()
+        self.__request(AUTH_API, params)
         self.sid = None
+        self.session.cookies.clear()
  
         self.__logger.debug("Logged out successfully")
 
     def user_info(self):
         if self.sid == None:
             self.__logger.error("No active session. Please login first.")
-        session = requests.Session()
-        session.cookies.set("id", self.sid)
-        api_info = self.get_api_info()
         PHOTO_USER = "SYNO.Foto.UserInfo"
-        photo_url = f"{self.url}/webapi/{api_info[PHOTO_USER]['path']}"
 
         params = {
-            "api": PHOTO_USER,
             "version": "1",
             "method": "me"
         }
-        response = session.get(photo_url, params=params, verify=False)
-        #print(response.url)
-        response.raise_for_status()
-        data = response.json()
+        data = self.__request(PHOTO_USER, params)
         if not data["success"]:
             self.__logger.error("Failed to get user information")
         else:
@@ -234,22 +344,14 @@ class SynologyAccess():
     def list_all_albums(self):
         if self.sid == None:
             self.__logger.error("No active session. Please login first.")
-        session = requests.Session()
-        session.cookies.set("id", self.sid)
-        api_info = self.get_api_info()
-        photo_url = f"{self.url}/webapi/{api_info[PHOTO_API]['path']}"
         params = {
-            "api": PHOTO_API,
             "version": "4",
             "category": "normal_share_with_me",
             "method": "list",
             "offset": "0",
             "limit": "1000"
         }
-        response = session.get(photo_url, params=params, verify=False)
-        #print(response.url)
-        response.raise_for_status()
-        data = response.json()
+        data = self.__request(PHOTO_API, params)
         #print(data)
         self.__logger.debug(data)
         theAlbums = {}
@@ -262,6 +364,7 @@ class SynologyAccess():
                 theAlbums[album['name']]['passphrase'] = album['passphrase']
                 theAlbums[album['name']]['owner_user_id'] = album['owner_user_id']
                 theAlbums[album['name']]['version'] = album['version']
+                theAlbums[album['name']]['item_count'] = album.get('item_count')
                 
         self.albumsInformation = theAlbums
         self.__logger.debug('The album list')
@@ -275,131 +378,182 @@ class SynologyAccess():
         if self.albumsInformation == {}:
             self.list_all_albums()
 
-
-        if album_name in self.fileInfoDict and not forceUpdate:
+        saved_version = self.__store.album_version(album_name)
+        if saved_version is not None and not forceUpdate:
             if album_name in self.albumsInformation:
-                if self.fileInfoDict[album_name]['version'] == self.albumsInformation[album_name]['version']:
+                if saved_version == self.albumsInformation[album_name]['version']:
                     # File information is up to date
-                    self.listFileIndexes = self.fileInfoDict[album_name]['fileIds']
-                    self.file_list = self.fileInfoDict[album_name]['fileInfo']
-                    if self.file_list != {}:
+                    album_index = AlbumIndex(self.__store.load_album(album_name))
+                    if len(album_index) > 0:
+                        self.__album_index = album_index
                         self.__logger.info('Album file list exists in saved file.')
                         return
-           
+
         # We need to fetch the file information
         if self.sid == None:
             self.__logger.error("No active session. Please login first.")
 
-        self.file_list = {}
-        self.listFileIndexes = []
-        
+        files = []
         if album_name in self.albumsInformation:
+            album = self.albumsInformation[album_name]
             self.__logger.info('Found album in album information, now retrieving file list')
-            session = requests.Session()
-            session.cookies.set("id", self.sid)
-            api_info = self.get_api_info()
-            photo_url = f"{self.url}/webapi/{api_info[PHOTO_BROWSE_ALBUM_API]['path']}"
-
-            # Fetch in batches of 1000
-            offset = 0
-
-            FetchedAll = False
-            while not FetchedAll:
-                self.__logger.info('Starting for loop to retrieve file list')
-                params = {
-                    "api": PHOTO_BROWSE_ALBUM_API,
-                    "method": "list",
-                    "version": "4",
-                    "offset": offset,
-                    "limit": '250',
-                    "id": 1,
-                    "passphrase": self.albumsInformation[album_name]['passphrase'],
-                    'additional': '["description","tag","exif","resolution","orientation","gps","video_meta","video_convert","thumbnail","address","geocoding_id","rating","motion_photo","provider_user_id","person"]'
-
-                }
-
-                response = session.get(photo_url, params=params, verify=False)
-                self.__logger.debug(response.text)
-                self.__logger.debug(response.url)
-                response.raise_for_status()
-                data = response.json()
-            
-                if not data["success"]:
-                    self.__logger.error("Failed to get album content")
-                elif len(data['data']['list']) != 0:
-                    self.__logger.info(len(data['data']['list']))
-                
-                
-                    counter = 0
-                    for file in data['data']['list']:
-                        counter = counter+1
-                            
-                        if file['folder_id'] in self.folderDict:
-                            theId = str(file['id'])
-                            self.file_list[theId] = {}
-                            if self.folderDict[file['folder_id']]['name'] == '/':
-                                self.file_list[theId]['fname'] = '/' + file['filename']
-                            else:
-                                self.file_list[theId]['fname'] = self.folderDict[file['folder_id']]['name'] + '/' + file['filename']
-                            if self.folderDict[file['folder_id']]['team'] == True:
-                                self.file_list[theId]['fname'] = 'shared' + self.file_list[theId]['fname']
-                            else:
-                                self.file_list[theId]['fname'] = 'mine' + self.file_list[theId]['fname']
-                                               
-                            if 'time' in file:
-                                self.file_list[theId]['exif_datetime'] = file['time']
-                                self.file_list[theId]['last_modified'] = file['time']
-                            else:
-                                self.file_list[theId]['exif_datetime'] = datetime.datetime.now()
-                                self.file_list[theId]['last_modified'] = datetime.datetime.now()
-
-                            if 'orientation' in file['additional']:
-                                self.file_list[theId]['orientation'] = file['additional']['orientation']
-                            if 'address' in file['additional']:
-                                if 'city' in file['additional']['address']:
-                                    self.file_list[theId]['location'] = file['additional']['address']['city']
-                                elif 'town' in file['additional']['address']:
-                                    self.file_list[theId]['location'] = file['additional']['address']['town']
-                                elif 'village ' in file['additional']['address']:
-                                    self.file_list[theId]['location'] = file['additional']['address']['village']
-                                if 'country' in file['additional']['address']:
-                                    self.file_list[theId]['location'] = self.file_list[theId]['location'] + ',' + file['additional']['address']['country']
-
-                            self.file_list[theId]['caption'] = self.folderDict[file['folder_id']]['name']
-                            self.file_list[theId]['file_id'] = theId
-
-                     
-                            self.listFileIndexes.append(theId)
-    
-                    if counter < 250:
-                        FetchedAll = True
-                        total = counter+offset
-                        self.__logger.info('Fetched ' + str(total ) + ' file infos')
-                    else:
-                        offset = offset + 250
-                        self.__logger.info(str(offset))
-                        
-                            
-            tempAlbumInfo = {}
-            tempAlbumInfo['version'] = self.albumsInformation[album_name]['version']
-            tempAlbumInfo['fileIds'] = self.listFileIndexes 
-            tempAlbumInfo['fileInfo'] = self.file_list
-            self.fileInfoDict[album_name] = tempAlbumInfo
-            self.save_folderdict_to_file(DEFAULT_FILEINFO_FILE)
-            
+            old_file_list = {}
+            if saved_version is not None:
+                old_file_list = {info['file_id']: info for info in self.__store.load_album(album_name)}
+            if old_file_list:
+                files = self.__sync_album(album, old_file_list)
+            else:
+                items = self.__list_album_items(album, ALBUM_ADDITIONAL)
+                if items is not None:
+                    for file in items:
+                        self.__add_file(file, files)
+                else:
+                    files = None
+            if files is None:  # stopped or failed part way, so keep the saved version
+                self.__logger.warning('Album %s not fetched completely, keeping version %s', album_name,
+                                      saved_version)
+                files = list(old_file_list.values())
+            else:
+                self.__logger.info('Fetched ' + str(len(files)) + ' file infos')
+                self.__store.save_album(album_name, album['version'], files)
+
         else:
-            self.__logger.info('Album does not exist: ', album_name)
-    
+            self.__logger.info('Album does not exist: %s', album_name)
 
         self.__logger.debug('File list')
-        self.__logger.debug(self.file_list)
-        self.__logger.debug('File indexes')
-        self.__logger.debug(self.listFileIndexes)
+        self.__logger.debug(files)
+        self.__album_index = AlbumIndex(files)
+
+    def __sync_album(self, album, old_file_list):
+        # The album has changed since old_file_list was saved. Only the ids, names, folders and times
+        # are listed, which needs no additional fields, and just the items not seen before are
+        # fetched with orientation and address. Items that have gone are dropped
+        items = self.__list_album_items(album, None)
+        if items is None:
+            return None
+        new_ids = [str(file['id']) for file in items if str(file['id']) not in old_file_list]
+        new_items = self.__get_album_items(album, new_ids)
+        if new_items is None:
+            return None
+        new_items = {str(file['id']): file for file in new_items}
+        self.__logger.info('Album has %d items, %d of them new', len(items), len(new_ids))
+        files = []
+        for file in items:
+            theId = str(file['id'])
+            if theId in new_items:
+                self.__add_file(new_items[theId], files)
+            elif theId in old_file_list:
+                old = old_file_list[theId]
+                info = self.__add_file(dict(file, additional={}), files)
+                if info is not None:  # file name or folder may have changed, the rest can't have
+                    for key in ('orientation', 'location'):
+                        if key in old:
+                            info[key] = old[key]
+        return files
+
+    def __album_params(self, album, additional):
+        params = {
+            "version": "4",
+            "id": 1,
+            "passphrase": album['passphrase'],
+        }
+        if additional is not None:
+            params['additional'] = additional
+        return params
+
+    def __list_album_items(self, album, additional):
+        """Returns all the items of album, fetching ALBUM_FETCH_WORKERS pages at once. The number of
+        pages comes from the item_count of the album list, more are fetched while the last one is full.
+        Returns None if a page can't be fetched or _stop_event is set before they all are."""
+        params = dict(self.__album_params(album, additional), method="list", limit=ALBUM_PAGE_SIZE)
+        n_pages = max(1, -(-(album.get('item_count') or 0) // ALBUM_PAGE_SIZE))
+        pages = {}
+        with ThreadPoolExecutor(max_workers=ALBUM_FETCH_WORKERS) as executor:
+            first_page = 0
+            while not self._stop_event.is_set():
+                futures = {executor.submit(self.__request, PHOTO_BROWSE_ALBUM_API,
+                                           dict(params, offset=page * ALBUM_PAGE_SIZE)): page
+                           for page in range(first_page, n_pages)}
+                for future in as_completed(futures):
+                    data = future.result()
+                    if not data["success"]:
+                        self.__logger.error("Failed to get album content")
+                        return None
+                    if self._stop_event.is_set():
+                        for other in futures:
+                            other.cancel()
+                        return None
+                    pages[futures[future]] = data['data']['list']
+                if len(pages[n_pages - 1]) < ALBUM_PAGE_SIZE:
+                    return [file for page in sorted(pages) for file in pages[page]]
+                first_page, n_pages = n_pages, n_pages + ALBUM_FETCH_WORKERS  # more items than item_count said
+        return None
+
+    def __get_album_items(self, album, ids):
+        """Returns the items of album with the given ids and the additional fields picframe uses, None
+        if they can't all be fetched."""
+        params = dict(self.__album_params(album, ALBUM_ADDITIONAL), method="get")
+        batches = [ids[i:i + ALBUM_PAGE_SIZE] for i in range(0, len(ids), ALBUM_PAGE_SIZE)]
+        items = []
+        with ThreadPoolExecutor(max_workers=ALBUM_FETCH_WORKERS) as executor:
+            futures = [executor.submit(self.__request, PHOTO_BROWSE_ALBUM_API,
+                                       dict(params, id=json.dumps([int(theId) for theId in batch])))
+                       for batch in batches]
+            for future in futures:
+                data = future.result()
+                if not data["success"]:
+                    self.__logger.error("Failed to get album items")
+                    for other in futures:
+                        other.cancel()
+                    return None
+                items.extend(data['data']['list'])
+        return items
+
+    def __add_file(self, file, files):
+        """Appends the file info of an album item to files and returns it, None if its folder isn't known."""
+        if file['folder_id'] not in self.folderDict:
+            return None
+        theId = str(file['id'])
+        info = {}
+        if self.folderDict[file['folder_id']]['name'] == '/':
+            info['fname'] = '/' + file['filename']
+        else:
+            info['fname'] = self.folderDict[file['folder_id']]['name'] + '/' + file['filename']
+        if self.folderDict[file['folder_id']]['team'] == True:
+            info['fname'] = 'shared' + info['fname']
+        else:
+            info['fname'] = 'mine' + info['fname']
+
+        if 'time' in file:
+            info['exif_datetime'] = file['time']
+            info['last_modified'] = file['time']
+        else:
+            info['exif_datetime'] = time.time()  # a number like 'time' for the viewer
+            info['last_modified'] = time.time()
+
+        if 'orientation' in file['additional']:
+            info['orientation'] = file['additional']['orientation']
+        if 'address' in file['additional']:
+            if 'city' in file['additional']['address']:
+                info['location'] = file['additional']['address']['city']
+            elif 'town' in file['additional']['address']:
+                info['location'] = file['additional']['address']['town']
+            elif 'village ' in file['additional']['address']:
+                info['location'] = file['additional']['address']['village']
+            if 'country' in file['additional']['address']:
+                info['location'] = info['location'] + ',' + file['additional']['address']['country']
+
+        info['caption'] = self.folderDict[file['folder_id']]['name']
+        info['file_id'] = theId
+
+        files.append(info)
+        return info
 
 
     def getFilePathFromFileList(self, fileIndex):
-        if fileIndex in self.listFileIndexes:
-            return self.file_list[fileIndex]['fname']
+        info = self.__album_index.get(fileIndex)
+        if info is not None:
+            return info['fname']
         else:
             self.__logger.debug('File index not in file index list')
             
@@ -415,7 +569,7 @@ class SynologyAccess():
         self.build_folder_dictionary(True)
         if self._stop_event.is_set():
             return
-        self.save_folderdict_to_file(FOLDER_INFO)
+        self.__store.save_folders(self.folderDict)
 
     def get_root_folder(self, team=False):
         if team == True:
@@ -424,20 +578,13 @@ class SynologyAccess():
             theAPI = PHOTO_BROWSE_FOLDER_API
         if self.sid == None:
             self.__logger.error("No active session. Please login first.")
-        session = requests.Session()
-        session.cookies.set("id", self.sid)
-        api_info = self.get_api_info()
-        photo_url = f"{self.url}/webapi/{api_info[theAPI]['path']}"
         params = {
-            "api": theAPI,
             "version": "2",
             "method": "get",
             "offset": 0,
             "limit": 1000
         }
-        response = session.get(photo_url, params=params, verify=False)
-        response.raise_for_status()
-        data = response.json()
+        data = self.__request(theAPI, params)
 
         rootFolder = {}
         if not data["success"]:
@@ -461,17 +608,27 @@ class SynologyAccess():
         self.walk_the_folders(folders, team)
 
     def walk_the_folders(self, theDict, team):
-        if not theDict:
-            return
-
-
-        for key, value in theDict.items():
-            if self._stop_event.is_set():
-                break
-            if isinstance(value, dict):  # Check if the value is a dictionary
-                theFolders = self.get_folders(key, team)
-                self.folderDict.update(theFolders)
-                self.walk_the_folders(theFolders, team)  # Recursive call
+        """Adds all the folders below those in theDict to folderDict. The tree is crawled breadth first
+        with up to FOLDER_CRAWL_WORKERS folders listed at once, each as soon as its parent has been.
+        Stops early, leaving folderDict part filled, when _stop_event is set."""
+        pending = collections.deque(theDict)
+        running = {}  # future -> parent folder id
+        with ThreadPoolExecutor(max_workers=FOLDER_CRAWL_WORKERS) as executor:
+            while (pending or running) and not self._stop_event.is_set():
+                while pending and len(running) < FOLDER_CRAWL_WORKERS:
+                    parent = pending.popleft()
+                    running[executor.submit(self.get_folders, parent, team)] = parent
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    parent = running.pop(future)
+                    try:
+                        theFolders = future.result()
+                    except (requests.RequestException, ValueError, KeyError) as e:
+                        self.__logger.warning("Can't list folder %s: %s", parent, e)
+                        continue
+                    self.folderDict.update(theFolders)
+                    pending.extend(theFolders)
+        # if stopped leaving the with block waits for the requests in flight, get_folders() won't start any more
 
     def get_folders(self, parent=None, team=False):
         if team == True:
@@ -480,33 +637,29 @@ class SynologyAccess():
             theAPI = PHOTO_BROWSE_FOLDER_API
         if self.sid == None:
             self.__logger.error("No active session. Please login first.")
-        session = requests.Session()
-        session.cookies.set("id", self.sid)
-        api_info = self.get_api_info()
-        photo_url = f"{self.url}/webapi/{api_info[theAPI]['path']}"
         params = {
-            "api": theAPI,
             "version": "2",
             "method": "list",
             "offset": 0,
-            "limit": 1000
+            "limit": FOLDER_PAGE_SIZE
         }
         if parent != None:
             params["id"] = parent
-    
-        response = session.get(photo_url, params=params, verify=False)
-        response.raise_for_status()
-        data = response.json()
 
         theFolders = {}
-        if not data["success"]:
-            self.__logger.error("Failed to list team folders")
-        elif len(data['data']['list']) != 0:
+        while not self._stop_event.is_set():
+            data = self.__request(theAPI, params)
+            if not data["success"]:
+                self.__logger.error("Failed to list team folders")
+                break
             for folder in data['data']['list']:
                  theFolders[folder['id']] = {}
                  theFolders[folder['id']]['name'] = folder['name']
                  theFolders[folder['id']]['passphrase'] = folder['passphrase']
                  theFolders[folder['id']]['team'] = team
+            if len(data['data']['list']) < FOLDER_PAGE_SIZE:
+                break
+            params["offset"] += FOLDER_PAGE_SIZE  # more children than fit in one reply
 
         return theFolders
     
@@ -534,18 +687,14 @@ class SynologyAccess():
         #print('The album')
         #print(album)
         self.get_album(album)
-        #print('List indexes')
-        #print(self.listFileIndexes)
-        return self.listFileIndexes
+        return self.__album_index.ids.copy()  # the caller may shuffle it
 
     def get_file_info(self, theId):
-        if theId in self.listFileIndexes:
-            #print('File info')
-            #print(theId)
-            #print(self.file_list[theId])
-            return self.file_list[theId]
+        info = self.__album_index.get(theId)
+        if info is not None:
+            return info
         else:
-            self.__logger.debug('File id is not present in index list', theId)
+            self.__logger.debug('File id %s is not present in index list', theId)
             return {}
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+import logging
+import os
+import sqlite3
+import threading
+
+
+class SynologyStore:
+    """Keeps the Synology folder map and the file info of each album fetched in an sqlite db,
+    replacing the folder.pkl and fileinfo.pkl pickles which were rewritten whole for every
+    album fetched and read whole at start up.
+
+    Folders are held as in SynologyAccess.folderDict i.e. folder_id -> {'name', 'passphrase',
+    'team'}, albums as their version and a list of file info dicts in album order.
+    """
+
+    FILE_FIELDS = ('fname', 'exif_datetime', 'last_modified', 'orientation', 'location', 'caption')
+
+    def __init__(self, db_file):
+        self.__logger = logging.getLogger("synology_store.SynologyStore")
+        if db_file != ':memory:':
+            os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        self.__lock = threading.Lock()  # shared by the folder scan thread and the album updates
+        self.__db = sqlite3.connect(db_file, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        self.__db.execute("PRAGMA journal_mode = WAL")
+        self.__db.execute("PRAGMA synchronous = NORMAL")
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS syno_folder (
+                folder_id INTEGER NOT NULL PRIMARY KEY,
+                name TEXT NOT NULL,
+                passphrase TEXT,
+                team INTEGER DEFAULT 0 NOT NULL
+            )""")
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS syno_album (
+                name TEXT NOT NULL PRIMARY KEY,
+                version INTEGER
+            )""")
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS syno_album_file (
+                album TEXT NOT NULL REFERENCES syno_album (name) ON DELETE CASCADE,
+                file_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                fname TEXT,
+                exif_datetime REAL,
+                last_modified REAL,
+                orientation INTEGER,
+                location TEXT,
+                caption TEXT,
+                PRIMARY KEY (album, file_id)
+            )""")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS syno_album_file_position ON syno_album_file (album, position)")
+        self.__db.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    def is_empty(self):
+        with self.__lock:
+            return (self.__db.execute("SELECT 1 FROM syno_folder LIMIT 1").fetchone() is None and
+                    self.__db.execute("SELECT 1 FROM syno_album LIMIT 1").fetchone() is None)
+
+    def load_folders(self):
+        with self.__lock:
+            rows = self.__db.execute("SELECT folder_id, name, passphrase, team FROM syno_folder").fetchall()
+        return {row['folder_id']: {'name': row['name'], 'passphrase': row['passphrase'], 'team': bool(row['team'])}
+                for row in rows}
+
+    def save_folders(self, folders):
+        """Inserts or updates the folders, rows already the same aren't written."""
+        sql = """INSERT INTO syno_folder (folder_id, name, passphrase, team) VALUES (?, ?, ?, ?)
+                 ON CONFLICT (folder_id) DO UPDATE SET
+                    name = excluded.name, passphrase = excluded.passphrase, team = excluded.team
+                 WHERE name IS NOT excluded.name OR passphrase IS NOT excluded.passphrase
+                    OR team IS NOT excluded.team"""
+        with self.__lock:
+            self.__db.executemany(sql, [(folder_id, folder['name'], folder.get('passphrase'), int(folder['team']))
+                                        for folder_id, folder in folders.items()])
+            self.__db.commit()
+
+    def album_version(self, album):
+        """Returns the version of the album when it was saved or None if it hasn't been."""
+        with self.__lock:
+            row = self.__db.execute("SELECT version FROM syno_album WHERE name = ?", (album,)).fetchone()
+        return None if row is None else row['version']
+
+    def load_album(self, album):
+        """Returns the file info dicts of album in album order, empty if it hasn't been saved."""
+        sql = """SELECT file_id, {0} FROM syno_album_file WHERE album = ?
+                 ORDER BY position""".format(", ".join(SynologyStore.FILE_FIELDS))
+        with self.__lock:
+            rows = self.__db.execute(sql, (album,)).fetchall()
+        return [{key: row[key] for key in row.keys() if row[key] is not None} for row in rows]
+
+    def save_album(self, album, version, files):
+        """Replaces the saved files of album with files, a list of file info dicts in album order.
+        Only rows that have changed are written."""
+        fields = ('file_id', 'position') + SynologyStore.FILE_FIELDS
+        sql = """INSERT INTO syno_album_file ({0}) VALUES ({1})
+                 ON CONFLICT (album, file_id) DO UPDATE SET {2}
+                 WHERE {3}""".format(
+            "album, " + ", ".join(fields), ", ".join("?" * (len(fields) + 1)),
+            ", ".join("{0} = excluded.{0}".format(field) for field in fields[1:]),
+            " OR ".join("{0} IS NOT excluded.{0}".format(field) for field in fields[1:]))
+        rows = [(album, info['file_id'], position) + tuple(info.get(field) for field in SynologyStore.FILE_FIELDS)
+                for position, info in enumerate(files)]
+        with self.__lock:
+            try:
+                self.__db.execute("""INSERT INTO syno_album (name, version) VALUES (?, ?)
+                                     ON CONFLICT (name) DO UPDATE SET version = excluded.version""",
+                                  (album, version))
+                self.__db.execute("CREATE TEMP TABLE IF NOT EXISTS keep_file (file_id TEXT PRIMARY KEY)")
+                self.__db.execute("DELETE FROM keep_file")
+                self.__db.executemany("INSERT OR IGNORE INTO keep_file VALUES (?)", [(row[1],) for row in rows])
+                self.__db.execute("""DELETE FROM syno_album_file WHERE album = ?
+                                     AND file_id NOT IN (SELECT file_id FROM keep_file)""", (album,))
+                self.__db.executemany(sql, rows)
+                self.__db.commit()
+            except sqlite3.Error as e:
+                self.__db.rollback()
+                self.__logger.warning("Can't save album %s: %s", album, e)
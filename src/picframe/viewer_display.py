@@ -3,9 +3,11 @@ import time
 import subprocess
 import logging
 import os
+import queue
+import threading
 import numpy as np
 from PIL import Image, ImageFilter, ImageFile
-from picframe import mat_image, get_image_meta
+from picframe import mat_image, get_image_meta, frame_cache
 from datetime import datetime
 
 # supported display modes for display switch
@@ -103,6 +105,23 @@ class ViewerDisplay:
         self.__clock_hgt_offset_pct = config['clock_hgt_offset_pct']
         self.__image_overlay = None
         self.__prev_overlay_time = None
+        self.__prefetch_depth = int(config['prefetch_depth'])  # number of upcoming slides prepared in advance
+        self.__prefetch_queue = queue.Queue()  # (key, pics, size, keep) for the prefetch thread, key None to stop it
+        self.__prefetch_wanted = []  # keys of the upcoming slides
+        self.__warmup_wanted = []  # keys of the slides after those, only rendered into the frame cache
+        self.__prefetch_ready = {}  # key -> image prepared by the prefetch thread
+        self.__prefetch_in_flight = None  # key of the image the prefetch thread is getting
+        self.__ready_changed = threading.Condition()  # for __prefetch_ready and __prefetch_in_flight
+        self.__prefetch_thread = None
+        self.__prepare_lock = threading.Lock()  # MatImage isn't thread safe so only prepare one image at a time
+        self.__frame_cache = None
+        if config['frame_cache']:
+            self.__frame_cache = frame_cache.FrameCache(os.path.expanduser(config['frame_cache_dir']),
+                                                        config['frame_cache_size'], config['frame_cache_format'])
+        self.__frame_cache_warmup = int(config['frame_cache_warmup']) if self.__frame_cache is not None else 0
+        self.__frame_tm = None  # time the previous frame was drawn
+        self.__frame_stats = {}
+        self.__reset_frame_stats()
         ImageFile.LOAD_TRUNCATED_IMAGES = True  # occasional damaged file hangs app
 
     @property
@@ -271,6 +290,15 @@ class ViewerDisplay:
             im = im.transpose(Image.ROTATE_90)
         return im
 
+    def __decode_size(self, pic, size):
+        # size the image needs before __orientate_image() to still cover the display without upscaling
+        if size is None:
+            return None
+        ext = os.path.splitext(pic.fname)[1].lower()
+        if ext not in ('.heif', '.heic') and pic.orientation in (5, 6, 7, 8):
+            return (size[1], size[0])
+        return size
+
     def __get_mat_image_control_values(self, mat_images_value):
         on = True
         val = 0.01
@@ -296,7 +324,8 @@ class ViewerDisplay:
             diff_aspect = 1 - (screen_aspect / image_aspect)
         return (screen_aspect, image_aspect, diff_aspect)
 
-    def __tex_load(self, pics, size=None):  # noqa: C901
+    def __prepare_image(self, pics, size=None):  # noqa: C901
+        # everything up to the Texture, this doesn't need the GL context so can run on the prefetch thread
         try:
             if self.__mat_images and self.__matter is None:
                 self.__matter = mat_image.MatImage(display_size=(self.__display.width, self.__display.height),
@@ -311,14 +340,14 @@ class ViewerDisplay:
 
             # Load the image(s) and correct their orientation as necessary
             if pics[0]:
-                im = get_image_meta.GetImageMeta.get_image_object(pics[0].fname)
+                im = get_image_meta.GetImageMeta.get_image_object(pics[0].fname, self.__decode_size(pics[0], size))
                 if im is None:
                     return None
                 if pics[0].orientation != 1:
                     im = self.__orientate_image(im, pics[0])
 
             if pics[1]:
-                im2 = get_image_meta.GetImageMeta.get_image_object(pics[1].fname)
+                im2 = get_image_meta.GetImageMeta.get_image_object(pics[1].fname, self.__decode_size(pics[1], size))
                 if im2 is None:
                     return None
                 if pics[1].orientation != 1:
@@ -360,14 +389,130 @@ class ViewerDisplay:
                     im_b.paste(im, box=(round(0.5 * (im_b.size[0] - im.size[0])),
                                         round(0.5 * (im_b.size[1] - im.size[1]))))
                     im = im_b  # have to do this as paste applies in place
+        except Exception as e:
+            self.__logger.warning("Can't create tex from file: \"%s\" or \"%s\"", pics[0].fname, pics[1])
+            self.__logger.warning("Cause: %s", e)
+            im = None
+            # raise # only re-raise errors here while debugging
+        return im
+
+    def __prefetch_key(self, pics):
+        # anything changing the prepared image has to be part of the key
+        return (tuple((pic.fname, pic.orientation) if pic else None for pic in pics),
+                self.__mat_images, self.__mat_images_tol)
+
+    def __frame_cache_key(self, pics, size):
+        # the source files' mtimes and every setting used by __prepare_image(), None if a file has gone
+        try:
+            files = tuple((pic.fname, os.path.getmtime(pic.fname), pic.orientation) if pic else None for pic in pics)
+        except OSError:
+            return None
+        return frame_cache.FrameCache.make_key(
+            files, size, self.__fit, self.__mat_images, self.__mat_images_tol, self.__mat_type,
+            self.__outer_mat_color, self.__inner_mat_color, self.__outer_mat_border, self.__inner_mat_border,
+            self.__outer_mat_use_texture, self.__inner_mat_use_texture, self.__mat_resource_folder,
+            self.__blur_edges, self.__blur_amount, self.__blur_zoom, self.__edge_alpha)
+
+    def __get_frame(self, pics, size, load=True):
+        # prepared image from the frame cache or from __prepare_image(), which is then added to the cache.
+        # With load False a cached image isn't read back and None is returned
+        if self.__frame_cache is None:
+            with self.__prepare_lock:
+                return self.__prepare_image(pics, size)
+        cache_key = self.__frame_cache_key(pics, size)
+        if cache_key is not None and cache_key in self.__frame_cache:
+            if not load:
+                return None
+            im = self.__frame_cache.get(cache_key)
+            if im is not None:
+                return im
+        with self.__prepare_lock:
+            im = self.__prepare_image(pics, size)
+        if im is not None and cache_key is not None:
+            self.__frame_cache.put(cache_key, im)
+        return im
+
+    def __tex_load(self, pics, size=None):
+        key = self.__prefetch_key(pics)
+        with self.__ready_changed:
+            while key == self.__prefetch_in_flight:  # the prefetch thread is busy with this image so wait for it
+                self.__ready_changed.wait()
+            im = self.__prefetch_ready.pop(key, False)
+        prefetched = im is not False
+        if not prefetched:
+            im = self.__get_frame(pics, size)
+        self.__frame_stats['prefetched'] = prefetched
+        if im is None:
+            return None
+        try:
             tex = pi3d.Texture(im, blend=True, m_repeat=True, free_after_load=True)
         except Exception as e:
             self.__logger.warning("Can't create tex from file: \"%s\" or \"%s\"", pics[0].fname, pics[1])
             self.__logger.warning("Cause: %s", e)
             tex = None
-            # raise # only re-raise errors here while debugging
         return tex
 
+    @property
+    def prefetch_depth(self):
+        return self.__prefetch_depth
+
+    @property
+    def lookahead(self):
+        """Number of upcoming pic sets prefetch() wants, the prefetched ones followed by the frame cache warm-up."""
+        return self.__prefetch_depth + self.__frame_cache_warmup
+
+    def prefetch(self, pic_sets):
+        """Prepare the images of the pic sets (as returned by Model.get_upcoming_pics()) on a background
+        thread so the next __tex_load() only has to create the Texture. Pic sets beyond prefetch_depth
+        are only rendered into the frame cache."""
+        if self.__prefetch_thread is None:
+            return
+        size = (self.__display.width, self.__display.height)
+        keys = [self.__prefetch_key(pics) for pics in pic_sets]
+        self.__prefetch_wanted = keys[:self.__prefetch_depth]
+        self.__warmup_wanted = keys[self.__prefetch_depth:]
+        with self.__ready_changed:
+            for key in list(self.__prefetch_ready.keys()):
+                if key not in self.__prefetch_wanted:  # not shown next after all, i.e. back, delete or reshuffle
+                    self.__prefetch_ready.pop(key, None)
+            ready = set(self.__prefetch_ready)
+        for i, (key, pics) in enumerate(zip(keys, pic_sets)):
+            if key not in ready:
+                self.__prefetch_queue.put((key, pics, size, i < self.__prefetch_depth))
+
+    def __prefetch_loop(self):
+        while True:
+            key, pics, size, keep = self.__prefetch_queue.get()
+            if key is None:
+                break
+            with self.__ready_changed:
+                if keep and (key in self.__prefetch_ready or key not in self.__prefetch_wanted):
+                    continue  # already done or no longer needed
+                if not keep and key not in self.__warmup_wanted:
+                    continue
+                self.__prefetch_in_flight = key
+            start = time.time()
+            im = False
+            try:
+                im = self.__get_frame(pics, size, load=keep)  # only holds __prepare_lock while preparing
+            finally:  # or __tex_load() would wait for it for ever
+                with self.__ready_changed:
+                    if keep and im is not False:
+                        self.__prefetch_ready[key] = im
+                    self.__prefetch_in_flight = None
+                    self.__ready_changed.notify_all()
+            self.__logger.debug("Prefetched %s in %.0f ms", pics[0].fname, (time.time() - start) * 1000)
+
+    def __reset_frame_stats(self):
+        self.__frame_stats = {'frames': 0, 'slow_frames': 0, 'max_frame_ms': 0.0,
+                              'tex_load_ms': 0.0, 'prefetched': False}
+
+    def get_frame_stats(self):
+        """Frame timing since the current slide started. slow_frames counts frames that took more than
+        1.5 times the frame time set by fps, tex_load_ms is the time taken on the render thread to load
+        the slide."""
+        return dict(self.__frame_stats)
+
     def __make_text(self, pic, paused, side=0, pair=False):  # noqa: C901
         # if side 0 and pair False then this is a full width text and put into
         # __textblocks[0] otherwise it is half width and put into __textblocks[position]
@@ -515,6 +660,9 @@ class ViewerDisplay:
         self.__slide.unif[55] = 1.0  # brightness
         self.__textblocks = [None, None]
         self.__flat_shader = pi3d.Shader("uv_flat")
+        if self.lookahead > 0:
+            self.__prefetch_thread = threading.Thread(target=self.__prefetch_loop, daemon=True)
+            self.__prefetch_thread.start()
 
         if self.__text_bkg_hgt:
             bkg_hgt = int(min(self.__display.width, self.__display.height) * self.__text_bkg_hgt)
@@ -528,9 +676,22 @@ class ViewerDisplay:
     def slideshow_is_running(self, pics=None, time_delay=200.0, fade_time=10.0, paused=False):  # noqa: C901
         loop_running = self.__display.loop_running()
         tm = time.time()
+        if self.__frame_tm is not None:
+            frame_ms = (tm - self.__frame_tm) * 1000
+            self.__frame_stats['frames'] += 1
+            self.__frame_stats['max_frame_ms'] = max(self.__frame_stats['max_frame_ms'], frame_ms)
+            if frame_ms > 1500.0 / self.__fps:
+                self.__frame_stats['slow_frames'] += 1
+        self.__frame_tm = tm
         if pics is not None:
+            stats = self.__frame_stats
+            self.__logger.info("Slide frames: %d, slow: %d, longest: %.0f ms, tex load: %.0f ms (prefetched %s)",
+                               stats['frames'], stats['slow_frames'], stats['max_frame_ms'],
+                               stats['tex_load_ms'], stats['prefetched'])
+            self.__reset_frame_stats()
             new_sfg = self.__tex_load(pics, (self.__display.width, self.__display.height))
             tm = time.time()
+            self.__frame_stats['tex_load_ms'] = (tm - self.__frame_tm) * 1000
             self.__next_tm = tm + time_delay
             self.__name_tm = tm + fade_time + self.__show_text_tm  # text starts after slide transition
             if new_sfg is not None:  # this is a possible return value which needs to be caught
@@ -625,4 +786,7 @@ class ViewerDisplay:
         return (loop_running, False)  # now returns tuple with skip image flag added
 
     def slideshow_stop(self):
+        if self.__prefetch_thread is not None:
+            self.__prefetch_queue.put((None, None, None, None))
+            self.__prefetch_thread.join()
         self.__display.destroy()
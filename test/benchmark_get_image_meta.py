@@ -0,0 +1,50 @@
+"""Compare meta data extraction speed of GetImageMeta with and without full image decode.
+
+Run from the repository root with::
+
+    python -m test.benchmark_get_image_meta [image files or directories]
+
+With no arguments the images in test/images are used.
+"""
+import os
+import sys
+import time
+
+from src.picframe.get_image_meta import GetImageMeta
+
+EXTENSIONS = ('.png', '.jpg', '.jpeg', '.heif', '.heic')
+
+
+def collect_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                             if os.path.splitext(f)[1].lower() in EXTENSIONS)
+        else:
+            files.append(path)
+    return files
+
+
+def run(files, header_only, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for fname in files:
+            exifs = GetImageMeta(fname, header_only=header_only)
+            exifs.get_size()  # ImageCache always asks for the size as well
+    return len(files) * repeat / (time.perf_counter() - start)
+
+
+def main():
+    files = collect_files(sys.argv[1:] or ['test/images'])
+    repeat = max(1, 100 // max(1, len(files)))
+    before = run(files, False, repeat)
+    after = run(files, True, repeat)
+    print("{} files x {} passes".format(len(files), repeat))
+    print("full decode : {:8.1f} files/sec".format(before))
+    print("header only : {:8.1f} files/sec ({:.1f}x)".format(after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Time ImageCache.query_cache() with portrait_pairs over a synthetic library.
+
+Run from the repository root with::
+
+    python -m test.benchmark_query_cache [number of files]
+
+The default is 100000 files, a third of them portraits, in 200 folders. The old two query
+pairing with list.pop(0) is timed on the same rows for comparison.
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from src.picframe.image_cache import ImageCache
+from test.conftest import NoGeoReverse
+
+
+def make_library(tmp_dir, n_files, n_folders=200):
+    pic_dir = os.path.join(tmp_dir, "pictures")
+    os.makedirs(pic_dir)
+    db_file = os.path.join(tmp_dir, "bench.db3")
+    ImageCache(pic_dir, False, db_file, None, 1).stop()  # create the schema
+    folders = []
+    for i in range(n_folders):
+        folder = os.path.join(pic_dir, "folder{:03d}".format(i))
+        os.makedirs(folder)
+        folders.append((i + 1, folder, os.path.getmtime(folder)))
+    rnd = random.Random(0)
+    with sqlite3.connect(db_file) as db:
+        db.executemany("INSERT INTO folder (folder_id, name, last_modified) VALUES (?, ?, ?)", folders)
+        db.executemany("INSERT INTO file (file_id, folder_id, basename, extension) VALUES (?, ?, ?, 'jpg')",
+                       [(i, 1 + i * n_folders // n_files, "img{:06d}".format(i)) for i in range(1, n_files + 1)])
+        meta = []
+        for i in range(1, n_files + 1):
+            portrait = rnd.random() < 1 / 3
+            meta.append((i, 1.6e9 + i * 60, 3000 if portrait else 4000, 4000 if portrait else 3000))
+        db.executemany("INSERT INTO meta (file_id, exif_datetime, width, height) VALUES (?, ?, ?, ?)", meta)
+    return pic_dir, db_file
+
+
+def old_pairing(db_file, where_clause, sort_clause):
+    with sqlite3.connect(db_file) as db:
+        full_list = db.execute("""SELECT CASE WHEN is_portrait = 0 THEN file_id ELSE -1 END
+                                  FROM all_data WHERE {0} ORDER BY {1}""".format(where_clause, sort_clause)).fetchall()
+        pair_list = db.execute("""SELECT file_id FROM all_data WHERE ({0}) AND is_portrait = 1
+                                  ORDER BY {1}""".format(where_clause, sort_clause)).fetchall()
+    newlist = []
+    skip_portrait_slot = False
+    for i in range(len(full_list)):
+        if full_list[i][0] != -1:
+            newlist.append(full_list[i])
+        elif skip_portrait_slot:
+            skip_portrait_slot = False
+        elif pair_list:
+            elem = pair_list.pop(0)
+            if pair_list:
+                elem += pair_list.pop(0)
+                skip_portrait_slot = True
+            newlist.append(elem)
+    return newlist
+
+
+def main():
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pic_dir, db_file = make_library(tmp_dir, n_files)
+        start = time.perf_counter()
+        entries = old_pairing(db_file, "1", "fname ASC")
+        print("{} files, {} playlist entries".format(n_files, len(entries)))
+        print("two queries + pop(0) : {:8.0f} ms".format((time.perf_counter() - start) * 1000))
+        for pairs_by in (None, 'date', 'folder'):
+            cache = ImageCache(pic_dir, False, db_file, NoGeoReverse(), 1000, portrait_pairs=True,
+                               portrait_pairs_by=pairs_by)
+            try:
+                start = time.perf_counter()
+                new_entries = cache.query_cache("1", "fname ASC")
+                print("one query, by {:6s} : {:8.0f} ms".format(str(pairs_by), (time.perf_counter() - start) * 1000))
+                if pairs_by is None:
+                    assert new_entries == entries
+            finally:
+                cache.stop()
+
+
+if __name__ == '__main__':
+    main()
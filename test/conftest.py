@@ -0,0 +1,51 @@
+"""Fixtures and helpers shared by the tests. The helpers are imported with
+``from test.conftest import ...``, pytest finds the fixtures itself."""
+import os
+import shutil
+import time
+
+import pytest
+
+from test.mock_dsm import MockDSM
+
+IMAGES = ("AlleExif.JPG", "test3.HEIC", "sample1.heic")
+
+
+class NoGeoReverse:
+    def get_address(self, lat, lon):
+        return ""
+
+    def cell_bounds(self, lat, lon):
+        return None
+
+
+def make_picture_dir(tmp_path, n_folders=3):
+    pic_dir = tmp_path / "pictures"
+    for i in range(n_folders):
+        folder = pic_dir / "folder{}".format(i)
+        folder.mkdir(parents=True)
+        for fname in IMAGES:
+            shutil.copy(os.path.join("test/images", fname), folder / fname)
+    return str(pic_dir)
+
+
+def wait_for_files(cache, n, timeout=20.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        rows = cache.query_cache("1")
+        if len(rows) >= n:
+            return rows
+        time.sleep(0.1)
+    return cache.query_cache("1")
+
+
+@pytest.fixture
+def dsm(tmp_path, monkeypatch):
+    """A MockDSM with the config.ini SynologyAccess logs in with, under HOME set to tmp_path."""
+    server = MockDSM()
+    config_dir = tmp_path / "picframe_data" / "config"
+    config_dir.mkdir(parents=True)
+    (config_dir / "config.ini").write_text("[nas]\nurl = {}\nusername = user\npassword = secret\n".format(server.url))
+    monkeypatch.setenv("HOME", str(tmp_path))
+    yield server
+    server.stop()
@@ -0,0 +1,174 @@
+"""A minimal stand-in for the Synology DSM web API used by SynologyAccess.
+
+MockDSM serves /webapi/entry.cgi on a local port from a background thread and counts
+the requests per 'api.method' and the TCP connections, so tests can check what
+SynologyAccess asks for. `folders` maps a folder id to (parent id, name) with None as
+the parent of the root folder, for both the personal and the team space. make_tree()
+builds bigger ones.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+APIS = ("SYNO.API.Auth", "SYNO.Foto.UserInfo", "SYNO.Foto.Browse.Album", "SYNO.Foto.Browse.Item",
+        "SYNO.FotoTeam.Browse.Item", "SYNO.Foto.Browse.Folder", "SYNO.FotoTeam.Browse.Folder")
+
+FOLDERS = {1: (None, "/"), 2: (1, "/holidays"), 3: (1, "/family"), 4: (2, "/holidays/2023")}
+TEAM_FOLDERS = {101: (None, "/"), 102: (101, "/shared")}
+
+
+def make_tree(depth, fan_out, first_id=1):
+    """Returns a folders dict with every folder down to depth having fan_out subfolders."""
+    folders = {first_id: (None, "/")}
+    level = [first_id]
+    next_id = first_id + 1
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fan_out):
+                folders[next_id] = (parent, "{}/f{}".format(folders[parent][1].rstrip("/"), i))
+                next_level.append(next_id)
+                next_id += 1
+        level = next_level
+    return folders
+
+
+def make_items(first_id, n, folder_id=2):
+    """Returns n album items with ids from first_id in folder_id."""
+    return [{"id": i, "filename": "img{}.jpg".format(i), "folder_id": folder_id, "time": 1700000000 + i,
+             "additional": {"orientation": 1 + i % 8, "address": {"city": "Sète", "country": "France"},
+                            "exif": {"iso": 100}, "thumbnail": {"cache_key": str(i)}}}
+            for i in range(first_id, first_id + n)]
+
+
+class MockDSM:
+    def __init__(self, folders=FOLDERS, team_folders=TEAM_FOLDERS, albums=None, items=None, latency=0.0):
+        self.folders = folders
+        self.team_folders = team_folders
+        self.albums = albums or []  # dicts with name, id, passphrase, owner_user_id, version
+        self.items = items or []  # dicts with id, filename, folder_id, time, additional, in album order
+        self.latency = latency  # seconds added to every reply, like a slow NAS
+        self.api_path = "entry.cgi"
+        self.requests = {}  # 'api.method' -> count
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0  # most requests being answered at the same time
+        self.additional = []  # the additional field list of each item request
+        self.fail_next = None  # error code returned for the next request, not counting SYNO.API.Info
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), self.__make_handler())
+        self.__server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.__server.server_address[1])
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def add_connection(self):
+        with self.__lock:
+            self.connections += 1
+
+    def start_request(self):
+        with self.__lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def end_request(self):
+        with self.__lock:
+            self.in_flight -= 1
+
+    def count(self, endpoint):
+        with self.__lock:
+            return self.requests.get(endpoint, 0)
+
+    def reply(self, params):
+        api = params.get("api")
+        method = params.get("method")
+        with self.__lock:
+            self.requests["{}.{}".format(api, method)] = self.requests.get("{}.{}".format(api, method), 0) + 1
+            fail, self.fail_next = (self.fail_next, None) if api != "SYNO.API.Info" else (None, self.fail_next)
+        if fail is not None:
+            return {"success": False, "error": {"code": fail}}
+        if api == "SYNO.API.Info":
+            return {"success": True, "data": {name: {"path": self.api_path, "minVersion": 1, "maxVersion": 6}
+                                              for name in APIS}}
+        if api == "SYNO.API.Auth":
+            return {"success": True, "data": {"sid": "mock-sid"} if method == "login" else {}}
+        if api == "SYNO.Foto.UserInfo":
+            return {"success": True, "data": {"id": 1}}
+        if api == "SYNO.Foto.Browse.Album":
+            albums = [dict(album, item_count=len(self.items)) for album in self.albums]
+            return {"success": True, "data": {"list": self.__page(albums, params)}}
+        if api in ("SYNO.Foto.Browse.Item", "SYNO.FotoTeam.Browse.Item"):
+            additional = json.loads(params.get("additional", "[]"))
+            with self.__lock:
+                self.additional.append(additional)
+            if method == "get":
+                ids = set(json.loads(params["id"]))
+                items = [item for item in self.items if item["id"] in ids]
+            else:
+                items = self.__page(self.items, params)
+            items = [self.__item(item, additional) for item in items]
+            return {"success": True, "data": {"list": items}}
+        if api in ("SYNO.Foto.Browse.Folder", "SYNO.FotoTeam.Browse.Folder"):
+            folders = self.team_folders if api.startswith("SYNO.FotoTeam") else self.folders
+            if method == "get":
+                root = next(folder_id for folder_id, (parent, _name) in folders.items() if parent is None)
+                return {"success": True, "data": {"folder": self.__folder(folders, root)}}
+            parent = int(params["id"]) if "id" in params else None
+            if parent is None:
+                parent = next(folder_id for folder_id, (p, _name) in folders.items() if p is None)
+            children = [self.__folder(folders, folder_id) for folder_id, (p, _name) in folders.items() if p == parent]
+            return {"success": True, "data": {"list": self.__page(children, params)}}
+        return {"success": False, "error": {"code": 102}}
+
+    @staticmethod
+    def __item(item, additional):
+        item = dict(item, additional={key: value for key, value in item.get("additional", {}).items()
+                                      if key in additional})
+        if not additional:
+            del item["additional"]
+        return item
+
+    @staticmethod
+    def __folder(folders, folder_id):
+        return {"id": folder_id, "name": folders[folder_id][1], "passphrase": ""}
+
+    @staticmethod
+    def __page(entries, params):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", len(entries)))
+        return entries[offset:offset + limit]
+
+    def __make_handler(self):
+        dsm = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+            disable_nagle_algorithm = True  # or each reply waits ~40 ms for the delayed ACK of the headers
+
+            def setup(self):
+                super().setup()
+                dsm.add_connection()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                dsm.start_request()
+                if dsm.latency:
+                    threading.Event().wait(dsm.latency)
+                body = json.dumps(dsm.reply(params)).encode("utf-8")
+                dsm.end_request()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,40 @@
+import pytest
+from PIL import Image
+
+from src.picframe.frame_cache import FrameCache
+
+
+def make_frame(colour, mode='RGB', size=(400, 300)):
+    return Image.new(mode, size, colour)
+
+
+@pytest.mark.parametrize("image_format", ['jpeg', 'webp', 'raw'])
+def test_put_get(tmp_path, image_format):
+    cache = FrameCache(str(tmp_path), 10, image_format)
+    key = FrameCache.make_key(("a.jpg", 1.0, 1), (400, 300), True)
+    assert key not in cache
+    assert cache.get(key) is None
+    cache.put(key, make_frame((200, 10, 10)))
+    assert key in cache
+    im = cache.get(key)
+    assert im.size == (400, 300)
+    assert abs(im.getpixel((10, 10))[0] - 200) < 5
+    cache.put(key + "a", make_frame((0, 0, 0, 128), 'RGBA'))  # blur_edges images have alpha
+    assert cache.get(key + "a").mode == 'RGBA'
+    # a new instance picks up what is already on disk
+    assert len(FrameCache(str(tmp_path), 10, image_format)) == 2
+
+
+def test_lru_eviction(tmp_path):
+    cache = FrameCache(str(tmp_path), 1, 'raw')  # room for two
+    cache.put("first", make_frame((1, 1, 1)))
+    cache.put("second", make_frame((2, 2, 2)))
+    cache.get("first")  # now second is the least recently used
+    cache.put("third", make_frame((3, 3, 3)))
+    assert "first" in cache
+    assert "second" not in cache
+    assert "third" in cache
+    assert cache.total_size <= 1024 * 1024
+    assert len(list(tmp_path.iterdir())) == 2
+    # a smaller limit evicts on start up
+    assert len(FrameCache(str(tmp_path), 0.5, 'raw')) == 1
@@ -0,0 +1,52 @@
+import io
+import json
+
+from src.picframe import geo_reverse
+
+
+def test_cell_lookup_shared(monkeypatch):
+    calls = []
+
+    def fake_urlopen(url, timeout):
+        calls.append(url)
+        data = {'features': [{'properties': {'address': {'city': 'Dubai', 'country': 'UAE'}}}]}
+        return io.BytesIO(json.dumps(data).encode())
+
+    monkeypatch.setattr(geo_reverse.urllib.request, "urlopen", fake_urlopen)
+    geo = geo_reverse.GeoReverse("test@example.com", key_list=[['city'], ['country']], cell_size=0.001)
+    assert geo.get_address(25.19731, 55.27441) == "Dubai, UAE"
+    assert geo.get_address(25.19739, 55.27449) == "Dubai, UAE"  # same cell
+    assert len(calls) == 1
+    assert geo.get_address(25.1990, 55.2744) == "Dubai, UAE"
+    assert len(calls) == 2
+    min_lat, max_lat, min_lon, max_lon = geo.cell_bounds(25.19731, 55.27441)
+    assert min_lat <= 25.19731 < max_lat and min_lon <= 55.27441 < max_lon
+    assert geo_reverse.GeoReverse("test@example.com").cell_bounds(25.19731, 55.27441) is None
+
+
+def test_local_csv(tmp_path):
+    csv_file = tmp_path / "places.csv"
+    csv_file.write_text("name,latitude,longitude,country\n"
+                        "Dubai,25.2048,55.2708,UAE\n"
+                        "Abu Dhabi,24.4539,54.3773,UAE\n"
+                        "Suva,-18.1248,178.4501,Fiji\n"
+                        "Taveuni,-16.8500,-179.9500,Fiji\n", encoding="utf-8")
+    geo = geo_reverse.LocalGeoReverse(str(csv_file))
+    assert geo.get_address(25.1973, 55.2744) == "Dubai, UAE"
+    assert geo.get_address(24.5, 54.4) == "Abu Dhabi, UAE"
+    assert geo.get_address(-16.9, 179.99) == "Taveuni, Fiji"  # across the 180 degree line
+    assert geo.get_address(0.0, 0.0) == ""  # nothing within max_distance
+    assert geo.cell_bounds(25.1973, 55.2744) is None
+
+
+def test_local_geonames(tmp_path):
+    rows = [["292223", "Dubai", "Dubai", "", "25.07725", "55.30927", "P", "PPLA", "AE", "", "03", "", "", "",
+             "3790000", "", "5", "Asia/Dubai", "2019-10-24"],
+            ["2643743", "London", "London", "", "51.50853", "-0.12574", "P", "PPLC", "GB", "", "ENG", "", "", "",
+             "8961989", "", "25", "Europe/London", "2023-01-12"]]
+    gn_file = tmp_path / "cities15000.txt"
+    gn_file.write_text("".join("\t".join(row) + "\n" for row in rows), encoding="utf-8")
+    geo = geo_reverse.LocalGeoReverse(str(gn_file), max_distance=100.0)
+    assert geo.get_address(25.1973, 55.2744) == "Dubai, AE"
+    assert geo.get_address(51.6, 0.1) == "London, GB"
+    assert geo.get_address(48.85, 2.35) == ""  # Paris is too far from London
@@ -1,5 +1,6 @@
 import pytest
 import logging
+from PIL import Image
 
 
 from src.picframe.get_image_meta import GetImageMeta
@@ -155,3 +156,39 @@ def test_exifs_heic():
 
     except Exception:
         pytest.fail("Unexpected exception")
+
+
+def test_header_only_matches_full_decode():
+    try:
+        for fname in ("test/images/AlleExif.JPG", "test/images/test3.HEIC", "test/images/sample1.heic"):
+            fast = GetImageMeta(fname)
+            slow = GetImageMeta(fname, header_only=False)
+            assert fast.get_size() == slow.get_size()
+            assert fast.get_location() == slow.get_location()
+            for key in ('EXIF DateTimeOriginal', 'Image Model', 'IPTC Keywords', 'IPTC Object Name'):
+                assert fast.get_exif(key) == slow.get_exif(key)
+    except Exception:
+        pytest.fail("Unexpected exception")
+
+
+def test_get_image_object_reduced():
+    try:
+        image = GetImageMeta.get_image_object("test/images/AlleExif.JPG", (480, 300))
+        assert image.size == (480, 300)  # JPEG draft 1/4
+        image = GetImageMeta.get_image_object("test/images/AlleExif.JPG", (500, 300))
+        assert image.size == (960, 600)  # never smaller than asked for
+        image = GetImageMeta.get_image_object("test/images/test3.HEIC", (1000, 1000))
+        assert image.size == (1008, 1344)  # reduced by 3
+        assert image.mode == "RGB"
+    except Exception:
+        pytest.fail("Unexpected exception")
+
+
+@pytest.mark.parametrize("mode", ["P", "1", "I;16", "LA"])
+def test_get_image_object_reduced_modes(tmp_path, mode):
+    fname = str(tmp_path / "big.png")
+    Image.new(mode, (4000, 3000)).save(fname)
+    image = GetImageMeta.get_image_object(fname, (1920, 1080))
+    assert image is not None
+    assert image.size == (2000, 1500)  # reduced by 2
+    assert image.mode == "RGB"
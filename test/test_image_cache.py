@@ -0,0 +1,324 @@
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+import pytest
+
+from src.picframe.geo_reverse import GeoReverse
+from src.picframe.image_cache import ImageCache
+from test.conftest import IMAGES, NoGeoReverse, make_picture_dir, wait_for_files
+
+
+@pytest.mark.parametrize("workers, pool", [(1, 'thread'), (3, 'thread'), (2, 'process')])
+def test_update_cache(tmp_path, workers, pool):
+    pic_dir = make_picture_dir(tmp_path)
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), NoGeoReverse(), 1,
+                       metadata_workers=workers, metadata_pool=pool)
+    try:
+        rows = wait_for_files(cache, 3 * len(IMAGES))
+        assert len(rows) == 3 * len(IMAGES)
+        info = cache.get_file_info(rows[0][0])
+        assert info['fname'] == os.path.join(pic_dir, "folder0", "AlleExif.JPG")
+        assert info['width'] == 1920 and info['height'] == 1200
+        assert info['tags'] == 'AidaPrima,Events,Kreuzfahrt,Land,'
+    finally:
+        cache.stop()
+
+
+def test_changed_file_keeps_file_id(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), NoGeoReverse(), 1)
+    try:
+        rows = wait_for_files(cache, len(IMAGES))
+        file_id = rows[0][0]
+        info = cache.get_file_info(file_id)
+        mod_tm = info['last_modified'] + 10
+        os.utime(info['fname'], (mod_tm, mod_tm))
+        info = cache.get_file_info(file_id)  # picks up the change on disk
+        assert info is not None
+        assert info['file_id'] == file_id
+        assert info['last_modified'] == mod_tm
+        assert len(cache.query_cache("1")) == len(IMAGES)
+    finally:
+        cache.stop()
+
+
+def test_get_file_infos(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), NoGeoReverse(), 1)
+    try:
+        file_ids = [row[0] for row in wait_for_files(cache, len(IMAGES))]
+        wanted = [file_ids[2], 9999, file_ids[0]]
+        infos = cache.get_file_infos(wanted)
+        assert [info['file_id'] if info else None for info in infos] == [file_ids[2], None, file_ids[0]]
+        info = cache.get_file_info(file_ids[2])  # from the prefetched row
+        assert info['fname'] == infos[0]['fname']
+        assert cache.get_file_info(file_ids[1])['file_id'] == file_ids[1]  # not prefetched
+    finally:
+        cache.stop()
+
+
+def test_read_during_write(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    db_file = str(tmp_path / "test.db3")
+    cache = ImageCache(pic_dir, False, db_file, NoGeoReverse(), 1)
+    try:
+        rows = wait_for_files(cache, len(IMAGES))
+        db = sqlite3.connect(db_file, timeout=0.1)
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        db.execute("BEGIN EXCLUSIVE")  # blocks readers unless the db is in WAL mode
+        db.execute("DELETE FROM file")
+        assert cache.query_cache("1") == rows  # doesn't wait or see the uncommitted delete
+        assert cache.get_file_infos([rows[0][0]])[0] is not None
+        db.rollback()
+        db.close()
+    finally:
+        cache.stop()
+
+
+def test_display_stats_batched(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    db_file = str(tmp_path / "test.db3")
+    cache = ImageCache(pic_dir, False, db_file, NoGeoReverse(), 1)
+    try:
+        file_id = wait_for_files(cache, len(IMAGES))[0][0]
+        cache.pause_looping(True)
+        time.sleep(0.5)
+        for _ in range(3):
+            cache.get_file_info(file_id)
+        assert cache.pending_display_stats == 1
+        stats = {row[0]: row[1] for row in cache.get_display_stats("1")}
+        assert stats[file_id] > 0.0  # includes the ones not written yet
+    finally:
+        cache.stop()
+    assert cache.pending_display_stats == 0
+    db = sqlite3.connect(db_file)
+    assert db.execute("SELECT displayed_count FROM file WHERE file_id = ?", (file_id,)).fetchone()[0] == 3
+    db.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is linux only")
+def test_inotify_watch_mode(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), NoGeoReverse(), 1, watch_mode='inotify')
+    try:
+        assert len(wait_for_files(cache, len(IMAGES))) == len(IMAGES)
+        new_folder = os.path.join(pic_dir, "new", "deeper")
+        os.makedirs(new_folder)
+        shutil.copy("test/images/AlleExif.JPG", os.path.join(new_folder, "copy.jpg"))
+        shutil.copy("test/images/AlleExif.JPG", os.path.join(pic_dir, "folder0", "copy.jpg"))
+        assert len(wait_for_files(cache, len(IMAGES) + 2)) == len(IMAGES) + 2
+        os.remove(os.path.join(pic_dir, "folder0", "test3.HEIC"))
+        end = time.time() + 10
+        while len(cache.query_cache("1")) != len(IMAGES) + 1 and time.time() < end:
+            time.sleep(0.1)
+        assert len(cache.query_cache("1")) == len(IMAGES) + 1
+    finally:
+        cache.stop()
+
+
+def test_prune_folders(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=2)
+    deep = os.path.join(pic_dir, "folder1", "2024", "05")
+    os.makedirs(deep)
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), NoGeoReverse(), 1, prune_folders=True)
+    try:
+        assert len(wait_for_files(cache, 2 * len(IMAGES))) == 2 * len(IMAGES)
+        time.sleep(2.5)  # let the next passes store the subfolders and run with pruning
+        day = os.path.join(deep, "18")  # only changes the mtime of 2024/05, not of its parents
+        os.makedirs(day)
+        shutil.copy("test/images/AlleExif.JPG", os.path.join(day, "new.jpg"))
+        assert len(wait_for_files(cache, 2 * len(IMAGES) + 1)) == 2 * len(IMAGES) + 1
+    finally:
+        cache.stop()
+
+
+class CountingGeoReverse(GeoReverse):
+    def __init__(self, address="Dubai"):
+        super().__init__("test@example.com", cell_size=0.001)
+        self.address = address
+        self.lookups = 0
+
+    def get_address(self, lat, lon):
+        self.lookups += 1
+        return self.address
+
+
+def wait_for_location(cache, file_id, timeout=10.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        location = cache.get_file_infos([file_id])[0]['location']
+        if location is not None:
+            return location
+        time.sleep(0.05)
+    return None
+
+
+def test_geo_location_in_background(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    db_file = str(tmp_path / "test.db3")
+    geo = CountingGeoReverse()
+    cache = ImageCache(pic_dir, False, db_file, geo, 1, geo_rate_limit=0.01)
+    try:
+        rows = wait_for_files(cache, len(IMAGES))
+        infos = cache.get_file_infos([row[0] for row in rows])
+        file_id = [info['file_id'] for info in infos if info['fname'].endswith("AlleExif.JPG")][0]
+        assert wait_for_location(cache, file_id) == "Dubai"
+        for info in infos:  # all looked up so the next lookups can only be for the moved position
+            if info['latitude'] is not None:
+                assert wait_for_location(cache, info['file_id']) is not None
+    finally:
+        cache.stop()
+    with sqlite3.connect(db_file) as db:  # a few metres away from the position already looked up
+        db.execute("UPDATE meta SET latitude = latitude + 0.00003 WHERE file_id = ?", (file_id,))
+    geo = CountingGeoReverse()
+    cache = ImageCache(pic_dir, False, db_file, geo, 1, geo_rate_limit=0.01)
+    try:
+        assert wait_for_location(cache, file_id) == "Dubai"
+        assert geo.lookups == 0  # same grid cell as the stored location
+    finally:
+        cache.stop()
+
+
+def test_geo_location_failure_doesnt_block(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    geo = CountingGeoReverse(address="")  # i.e. no network
+    # after the first failure the geo thread waits 2 minutes, far longer than any of the limits below
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), geo, 1, geo_rate_limit=60.0)
+    try:
+        rows = wait_for_files(cache, len(IMAGES))
+        end = time.time() + 10
+        while geo.lookups == 0 and time.time() < end:
+            time.sleep(0.05)
+        assert geo.lookups == 1
+        start = time.time()
+        for row in rows:
+            assert cache.get_file_info(row[0])['location'] is None
+        assert time.time() - start < 10.0
+    finally:
+        start = time.time()
+        cache.stop()
+        assert time.time() - start < 30.0  # the geo thread doesn't sit out its backoff
+
+
+def test_full_text_index(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=2)
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), CountingGeoReverse(), 1, geo_rate_limit=0.01)
+    match = "file_id IN (SELECT rowid FROM meta_fts WHERE meta_fts MATCH '{} : \"{}\"*')"
+    try:
+        rows = wait_for_files(cache, 2 * len(IMAGES))
+        assert len(cache.query_cache(match.format("tags", "kreuz"))) == 2  # AlleExif.JPG tags
+        assert len(cache.query_cache("NOT " + match.format("tags", "kreuz"))) == len(rows) - 2
+        end = time.time() + 10
+        while len(cache.query_cache(match.format("location", "dubai"))) < 4 and time.time() < end:
+            time.sleep(0.05)  # filled in by the location trigger once the geo thread has stored it
+        assert len(cache.query_cache(match.format("location", "dubai"))) == 4  # AlleExif.JPG and test3.HEIC
+        shutil.rmtree(os.path.join(pic_dir, "folder1"))
+        cache.purge_files()
+        end = time.time() + 10
+        while len(cache.query_cache(match.format("tags", "kreuz"))) > 1 and time.time() < end:
+            time.sleep(0.05)
+        assert len(cache.query_cache(match.format("tags", "kreuz"))) == 1
+    finally:
+        cache.stop()
+
+
+def test_location_trigger_uses_index(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    db_file = str(tmp_path / "test.db3")
+    ImageCache(pic_dir, False, db_file, None, 1).stop()
+    db = sqlite3.connect(db_file)
+    plan = db.execute("EXPLAIN QUERY PLAN SELECT file_id FROM meta WHERE latitude = 1.0 AND longitude = 2.0").fetchall()
+    db.close()
+    assert "USING COVERING INDEX meta_location" in plan[0][3]
+
+
+def test_get_modified_files(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=2)
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), NoGeoReverse(), 1)
+    try:
+        assert len(wait_for_files(cache, 2 * len(IMAGES))) == 2 * len(IMAGES)
+        cache.pause_looping(True)  # so the changes below are only seen here
+        time.sleep(0.5)  # for a pass of the loop that had started to finish
+        get_modified_files = cache._ImageCache__get_modified_files
+        folders = [(os.path.join(pic_dir, "folder{}".format(i)), 0) for i in range(2)]
+        assert get_modified_files(folders) == []  # a rescan with nothing changed queues nothing
+        fname = os.path.join(pic_dir, "folder1", "test3.HEIC")
+        mod_tm = os.path.getmtime(fname) + 10
+        os.utime(fname, (mod_tm, mod_tm))
+        for name in ("new.jpg", ".hidden.jpg", "notes.txt"):
+            shutil.copy("test/images/AlleExif.JPG", os.path.join(pic_dir, "folder0", name))
+        assert sorted(get_modified_files(folders)) == [os.path.join(pic_dir, "folder0", "new.jpg"), fname]
+    finally:
+        cache.stop()
+
+
+def test_failed_batch_keeps_other_writes(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=1)
+    db_file = str(tmp_path / "test.db3")
+    cache = ImageCache(pic_dir, False, db_file, None, 1000)  # no second pass while this runs
+    try:
+        assert len(wait_for_files(cache, len(IMAGES))) == len(IMAGES)
+        db = cache._ImageCache__db
+        db.execute("UPDATE file SET displayed_count = 7")  # not committed yet
+        fname = os.path.join(pic_dir, "folder0", "new.jpg")
+        cache._ImageCache__write_files([(fname, 1.0, {'no_such_column': 1})])
+        db.commit()
+    finally:
+        cache.stop()
+    with sqlite3.connect(db_file) as db:
+        assert db.execute("SELECT COUNT(*) FROM file WHERE displayed_count = 7").fetchone()[0] == len(IMAGES)
+        assert db.execute("SELECT COUNT(*) FROM file WHERE basename = 'new'").fetchone()[0] == 0
+
+
+def test_folder_prefix(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=0)
+    for folder in ("test", "test1", os.path.join("test", "sub")):
+        os.makedirs(os.path.join(pic_dir, folder))
+        shutil.copy("test/images/AlleExif.JPG", os.path.join(pic_dir, folder, "a.jpg"))
+    cache = ImageCache(pic_dir, False, str(tmp_path / "test.db3"), NoGeoReverse(), 1)
+    try:
+        assert len(wait_for_files(cache, 3)) == 3
+        name = os.path.join(pic_dir, "test")
+        rows = cache.query_cache(
+            "(folder_name = '{0}' OR (folder_name >= '{0}/' AND folder_name < '{0}0'))".format(name))
+        assert len(rows) == 2  # not test1
+    finally:
+        cache.stop()
+
+
+def test_portrait_pairs(tmp_path):
+    pic_dir = make_picture_dir(tmp_path, n_folders=0)
+    db_file = str(tmp_path / "test.db3")
+    os.makedirs(os.path.join(pic_dir, "a"))
+    os.makedirs(os.path.join(pic_dir, "b"))
+    ImageCache(pic_dir, False, db_file, None, 1).stop()
+    # file_id, folder, exif_datetime, portrait: L1 P2(a, t=5) L3 P4(b, t=1) P5(a, t=2) P6(b, t=6) P7(a, t=9)
+    files = [(1, "a", 0, False), (2, "a", 5, True), (3, "b", 0, False), (4, "b", 1, True),
+             (5, "a", 2, True), (6, "b", 6, True), (7, "a", 9, True)]
+    with sqlite3.connect(db_file) as db:
+        for folder_id, name in ((1, "a"), (2, "b")):
+            folder = os.path.join(pic_dir, name)
+            db.execute("INSERT INTO folder (folder_id, name, last_modified) VALUES (?, ?, ?)",
+                       (folder_id, folder, os.path.getmtime(folder)))
+        for file_id, folder, tm, portrait in files:
+            db.execute("INSERT INTO file (file_id, folder_id, basename, extension) VALUES (?, ?, ?, 'jpg')",
+                       (file_id, 1 if folder == "a" else 2, "f{}".format(file_id)))
+            db.execute("INSERT INTO meta (file_id, exif_datetime, width, height) VALUES (?, ?, ?, ?)",
+                       (file_id, tm, 3 if portrait else 4, 4 if portrait else 3))
+    expected = {None: [(1,), (2, 4), (3,), (5, 6), (7,)],
+                'date': [(1,), (2, 6), (3,), (4, 5), (7,)],
+                'folder': [(1,), (5, 2), (3,), (4, 6), (7,)]}  # 7 is the odd one out in a
+    for pairs_by, pairs in expected.items():
+        cache = ImageCache(pic_dir, False, db_file, NoGeoReverse(), 1, portrait_pairs=True,
+                           portrait_pairs_by=pairs_by)
+        try:
+            result = cache.query_cache("1", "file_id")
+            assert result == pairs
+            if pairs_by == 'folder':  # no pair spans two folders
+                folders = {file_id: folder for file_id, folder, _tm, _portrait in files}
+                assert all(len({folders[file_id] for file_id in pair}) == 1 for pair in result)
+        finally:
+            cache.stop()
@@ -0,0 +1,174 @@
+import threading
+import time
+
+import pytest
+import yaml
+
+from src.picframe import model as model_module
+from src.picframe.model import Model
+from test.conftest import IMAGES, make_picture_dir
+from test.mock_dsm import make_items
+
+
+@pytest.fixture
+def model_config(tmp_path, dsm):
+    """The model section of the configuration.yaml written by make_model(), for a picture folder.
+    dsm is for the Synology access Model always starts."""
+    return {'pic_dir': make_picture_dir(tmp_path, n_folders=2), 'pic_dir_mine': str(tmp_path / "mine"),
+            'db_file': str(tmp_path / "test.db3"), 'no_files_img': "test/images/AlleExif.JPG",
+            'load_geoloc': False, 'recent_n': 0, 'shuffle': False, 'update_interval': 1,
+            'weighted_selection': False, 'tags_filter': '', 'location_filter': '',  # Model changes DEFAULT_CONFIG
+            'useAlbum': False, 'albumName': '', 'mineAlbumName': ''}
+
+
+def make_model(tmp_path, config):
+    configfile = tmp_path / "configuration.yaml"
+    configfile.write_text(yaml.safe_dump({'viewer': {}, 'model': config, 'mqtt': {}, 'http': {}, 'peripherals': {}}))
+    return Model(str(configfile))
+
+
+def count_files(model, n_files):
+    """Returns the number of files get_next_file() goes through, waiting for n_files in the cache."""
+    end = time.time() + 10
+    while model.get_number_of_files() < n_files and time.time() < end:
+        model.shuffle = False  # reload
+        model.get_next_file()
+        time.sleep(0.05)
+    return model.get_number_of_files()
+
+
+def test_tags_filter(tmp_path, model_config):
+    n_files = 2 * len(IMAGES)
+    model = make_model(tmp_path, model_config)
+    try:
+        assert count_files(model, n_files) == n_files
+        for tags_filter, expected in (("kreuz", 2),  # AlleExif.JPG in each folder
+                                      ("KREU", 2),
+                                      ("kreuz AND NOT kreuz", 0),
+                                      ("kreuz OR (NOT kreuz)", n_files),
+                                      ("NOT kreuz", n_files - 2),
+                                      ("kreuz NOT kreuz", 0),  # with an implied AND
+                                      ("kreuz (kreuz)", 2),
+                                      ("(kreuz) kreuz", 2),
+                                      ("(kreuz) (NOT kreuz)", 0),
+                                      ("kreuz OR", n_files),  # not a filter so cleared
+                                      ("kreuz AND ()", n_files)):
+            model.tags_filter = tags_filter
+            model.get_next_file()
+            assert model.get_number_of_files() == expected, tags_filter
+    finally:
+        model.stop_image_chache()
+
+
+@pytest.mark.parametrize("load_geoloc", [False, True])
+def test_load_geoloc(tmp_path, model_config, monkeypatch, load_geoloc):
+    addresses = []
+    all_found = threading.Event()
+
+    class GeoReverse:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def get_address(self, lat, lon):
+            addresses.append((lat, lon))
+            if len(addresses) == 2:  # the two positions of AlleExif.JPG and test3.HEIC
+                all_found.set()
+            return "Dubai"
+
+        def cell_bounds(self, lat, lon):
+            return None
+
+    monkeypatch.setattr(model_module.geo_reverse, "GeoReverse", GeoReverse)
+    model_config.update(load_geoloc=load_geoloc, geo_rate_limit=0.0)
+    model = make_model(tmp_path, model_config)
+    try:
+        count_files(model, 2 * len(IMAGES))
+        if load_geoloc:
+            assert all_found.wait(timeout=30)
+        else:
+            assert model._Model__image_cache._ImageCache__geo_thread is None
+    finally:
+        model.stop_image_chache()  # which waits for the geo thread, if there is one
+    assert len(addresses) == (2 if load_geoloc else 0)
+
+
+def test_selection_weights(tmp_path, model_config):
+    n_files = 2 * len(IMAGES)
+    model_config.update(weighted_selection=True, rating_weight=0.5)
+    model = make_model(tmp_path, model_config)
+    try:
+        assert count_files(model, n_files) == n_files
+        for _ in range(3):
+            model.get_next_file()
+        image_cache = model._Model__image_cache
+        stats = {row[0]: row[1:] for row in image_cache.get_display_stats("1")}
+        now = time.time()
+        expected = []
+        for file_ids in model._Model__file_list:
+            last_displayed, rating = stats[file_ids[0]]
+            age = min(max(now - last_displayed, 1.0), Model.WEIGHT_MAX_AGE)
+            expected.append(age * (1.0 + 0.5 * max(rating or 0, 0)))
+        weights = model._Model__selection_weights()
+        n_shown = sum(1 for last_displayed, _rating in stats.values() if last_displayed)
+        assert sum(weight < Model.WEIGHT_MAX_AGE for weight in weights) == n_shown > 3
+        assert weights.tolist() == pytest.approx(expected, abs=1.0)
+    finally:
+        model.stop_image_chache()
+
+
+def test_weighted_selection_back(tmp_path, model_config):
+    n_files = 2 * len(IMAGES)
+    model_config.update(weighted_selection=True)
+    model = make_model(tmp_path, model_config)
+    try:
+        assert count_files(model, n_files) == n_files
+        model.shuffle = False  # a new pass so the picks below aren't all shown before the end
+        shown = [model.get_next_file()[0].file_id for _ in range(4)]
+        assert len(set(shown)) == 4
+        model.set_next_file_to_previous_file()
+        assert model.get_next_file()[0].file_id == shown[2]
+        model.set_next_file_to_previous_file()
+        assert model.get_next_file()[0].file_id == shown[1]
+        assert [model.get_next_file()[0].file_id for _ in range(2)] == shown[2:]
+    finally:
+        model.stop_image_chache()
+
+
+def test_album_drops_weighted_selection(tmp_path, model_config, dsm):
+    dsm.albums = [{"name": "trip", "id": 7, "passphrase": "abc", "owner_user_id": 2, "version": 1}]
+    dsm.items = make_items(1, 5)
+    model_config.update(weighted_selection=True)
+    model = make_model(tmp_path, model_config)
+    try:
+        count_files(model, 2 * len(IMAGES))
+        model.get_next_file()
+        model.get_next_file()
+        assert model._Model__sampler is not None
+        model.albumName = "trip"
+        model.useAlbum = True
+        model.refresh_file_list()
+        assert model.get_next_file()[0].file_id == 1
+        assert model._Model__sampler is None
+        assert not model._Model__weighted_picks and not model._Model__weighted_shown
+        assert model.get_next_file()[0].file_id == 2
+        model.set_next_file_to_previous_file()
+        assert model.get_next_file()[0].file_id == 1
+    finally:
+        model.stop_image_chache()
+
+
+def test_portrait_pairs_seeded(tmp_path, model_config):
+    n_files = 2 * len(IMAGES)
+    model_config.update(portrait_pairs=True, shuffle_seed=42)
+    playlists = []
+    for _ in range(2):  # the same seed gives the same pairs in the same order
+        model = make_model(tmp_path, model_config)
+        try:
+            count_files(model, n_files)
+            model.shuffle = True
+            model.get_next_file()
+            playlists.append(list(model._Model__file_list))
+        finally:
+            model.stop_image_chache()
+    assert playlists[0] == playlists[1]
+    assert sorted(file_id for entry in playlists[0] for file_id in entry) == list(range(1, n_files + 1))
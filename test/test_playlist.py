@@ -0,0 +1,64 @@
+import numpy as np
+
+from src.picframe.playlist import Playlist, WeightedSampler
+
+
+def test_entries():
+    playlist = Playlist([(3,), (5, 7), (9,)])
+    assert len(playlist) == 3
+    assert list(playlist) == [(3,), (5, 7), (9,)]
+    assert playlist[-1] == (9,)
+    assert playlist.max_id() == 9
+    assert playlist.first_ids().tolist() == [3, 5, 9]
+    assert playlist.pop(1) == (5, 7)
+    assert list(playlist) == [(3,), (9,)]
+    playlist.extend([(i,) for i in range(100, 200)])  # beyond the initial capacity
+    assert len(playlist) == 102
+    assert playlist[101] == (199,)
+
+
+def test_shuffle_seeded():
+    entries = [(i,) for i in range(1, 1001)]
+    playlist1 = Playlist(entries)
+    playlist2 = Playlist(entries)
+    playlist1.shuffle(np.random.default_rng(42))
+    playlist2.shuffle(np.random.default_rng(42))
+    assert list(playlist1) == list(playlist2)
+    assert list(playlist1) != entries
+    assert sorted(playlist1) == entries
+    playlist3 = Playlist(entries)
+    playlist3.shuffle(np.random.default_rng(1), start=500)
+    assert list(playlist3)[:500] == entries[:500]
+    assert sorted(playlist3) == entries
+
+
+def test_insert_random():
+    playlist = Playlist([(i,) for i in range(1, 11)])
+    playlist.insert_random([(20,), (21, 22)], np.random.default_rng(0), start=5)
+    assert len(playlist) == 12
+    assert list(playlist)[:5] == [(i,) for i in range(1, 6)]  # already shown
+    assert (20,) in list(playlist)[5:] and (21, 22) in list(playlist)[5:]
+    assert playlist.max_id() == 22
+
+
+def test_weighted_sampler():
+    rng = np.random.default_rng(0)
+    sampler = WeightedSampler([1.0, 0.0, 3.0, 0.0, 6.0])
+    assert sampler.total == 10.0
+    counts = np.bincount([sampler.sample(rng) for _ in range(20000)], minlength=5)
+    assert counts[1] == 0 and counts[3] == 0
+    assert abs(counts[4] / 20000 - 0.6) < 0.02
+    assert abs(counts[0] / 20000 - 0.1) < 0.02
+
+
+def test_weighted_sampler_each_once():
+    rng = np.random.default_rng(1)
+    sampler = WeightedSampler(rng.random(1000) + 0.01)
+    picked = []
+    while True:
+        index = sampler.sample(rng)
+        if index is None:
+            break
+        sampler.update(index, 0.0)
+        picked.append(index)
+    assert sorted(picked) == list(range(1000))
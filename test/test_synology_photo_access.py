@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+
+from src.picframe import synology_photo_access
+from src.picframe.synology_photo_access import AlbumIndex, SynologyAccess
+from src.picframe.synology_store import SynologyStore
+from test.mock_dsm import make_items, make_tree
+
+
+def test_folder_scan_reuses_session(dsm):
+    access = SynologyAccess()
+    try:
+        while access._thread.is_alive() and len(access.folderDict) < 6:
+            access._thread.join(timeout=0.05)
+        assert sorted(access.folderDict) == [1, 2, 3, 4, 101, 102]
+        assert access.folderDict[102]['team'] is True
+    finally:
+        access.stop()
+    assert dsm.count("SYNO.API.Info.query") == 1
+    assert dsm.connections <= synology_photo_access.FOLDER_CRAWL_WORKERS  # kept alive and shared by all threads
+    report = access.timing_report()
+    assert report["SYNO.Foto.Browse.Folder.list"][0] == dsm.count("SYNO.Foto.Browse.Folder.list")
+    assert report["SYNO.API.Auth.logout"][0] == 1
+
+
+def test_api_info_refreshed_on_error(dsm):
+    access = SynologyAccess()
+    try:
+        access.stop()  # only the direct calls below from now on
+        dsm.fail_next = 102  # as if the NAS had been updated and the API moved
+        access.list_all_albums()
+        assert dsm.count("SYNO.API.Info.query") == 2
+        assert dsm.count("SYNO.Foto.Browse.Album.list") == 2
+        access.list_all_albums()
+        assert dsm.count("SYNO.API.Info.query") == 2
+    finally:
+        access.session.close()
+
+
+def wait_for_scan(access, n_folders):
+    while access._thread.is_alive() and len(access.folderDict) < n_folders:
+        access._thread.join(timeout=0.05)
+
+
+def test_deep_tree_crawl(dsm, monkeypatch):
+    monkeypatch.setattr(synology_photo_access, "FOLDER_PAGE_SIZE", 4)  # so the 5 subfolders take two pages
+    dsm.folders = make_tree(depth=4, fan_out=5)  # 781 folders
+    dsm.team_folders = make_tree(depth=6, fan_out=1, first_id=10000)  # a chain
+    dsm.latency = 0.002
+    access = SynologyAccess()
+    try:
+        wait_for_scan(access, len(dsm.folders) + len(dsm.team_folders))
+        assert sorted(access.folderDict) == sorted(list(dsm.folders) + list(dsm.team_folders))
+        assert access.folderDict[10006]['name'] == "/f0/f0/f0/f0/f0/f0"
+    finally:
+        access.stop()
+    assert 1 < dsm.max_in_flight <= synology_photo_access.FOLDER_CRAWL_WORKERS + 1
+    # every folder listed once, with two pages for the 156 that aren't leaves
+    assert dsm.count("SYNO.Foto.Browse.Folder.list") == len(dsm.folders) + 156
+
+
+def test_crawl_stops(dsm):
+    dsm.folders = make_tree(depth=3, fan_out=10)
+    dsm.latency = 0.05
+    access = SynologyAccess()
+    wait_for_scan(access, 50)
+    access._stop_event.set()  # as stop() does first, then waits for the scan thread
+    in_flight = dsm.in_flight  # only counted once they have been answered
+    requests = dsm.count("SYNO.Foto.Browse.Folder.list")
+    access.stop()
+    assert dsm.count("SYNO.Foto.Browse.Folder.list") <= requests + in_flight  # none started since
+    assert len(access.folderDict) < len(dsm.folders)
+
+
+def test_album_sync(dsm, monkeypatch):
+    monkeypatch.setattr(synology_photo_access, "ALBUM_PAGE_SIZE", 10)
+    dsm.albums = [{"name": "trip", "id": 7, "passphrase": "abc", "owner_user_id": 2, "version": 1}]
+    dsm.items = make_items(1, 95)
+    access = SynologyAccess()
+    try:
+        wait_for_scan(access, len(dsm.folders) + len(dsm.team_folders))
+        assert access.get_file_list("trip").tolist() == list(range(1, 96))
+        assert access.get_file_info(5) == {'fname': 'mine/holidays/img5.jpg', 'exif_datetime': 1700000005,
+                                           'last_modified': 1700000005, 'orientation': 6,
+                                           'location': 'Sète,France', 'caption': '/holidays', 'file_id': 5}
+        assert access.get_file_info("5") == access.get_file_info(5)
+        assert access.get_file_info(96) == {}
+        assert dsm.count("SYNO.Foto.Browse.Item.list") == 10
+        assert all(additional == ["orientation", "address"] for additional in dsm.additional)
+
+        # 5 removed, 3 added and one moved to another folder
+        dsm.items = [item for item in dsm.items if item["id"] > 5] + make_items(200, 3, folder_id=3)
+        dsm.items[0] = dict(dsm.items[0], folder_id=4)
+        dsm.albums[0]["version"] = 2
+        dsm.additional.clear()
+        access.list_all_albums()
+        ids = access.get_file_list("trip")
+        assert ids.tolist() == list(range(6, 96)) + [200, 201, 202]
+        assert access.get_file_info(6)['fname'] == 'mine/holidays/2023/img6.jpg'
+        assert access.get_file_info(6)['orientation'] == 7  # kept from before
+        assert access.get_file_info(201)['location'] == 'Sète,France'
+        assert access.getFilePathFromFileList(201) == 'mine/family/img201.jpg'
+        assert dsm.count("SYNO.Foto.Browse.Item.get") == 1  # only the new ones with additional fields
+        assert dsm.additional.count([]) == 10
+    finally:
+        access.stop()
+
+
+def test_album_saved(dsm):
+    dsm.albums = [{"name": "trip", "id": 7, "passphrase": "abc", "owner_user_id": 2, "version": 1}]
+    dsm.items = make_items(1, 30)
+    access = SynologyAccess()
+    try:
+        wait_for_scan(access, len(dsm.folders) + len(dsm.team_folders))
+        expected = access.get_file_list("trip").tolist()
+        expected_info = access.get_file_info(12)
+    finally:
+        access.stop()
+    access = SynologyAccess()  # the folders and the unchanged album come from the store
+    try:
+        assert len(access.folderDict) == len(dsm.folders) + len(dsm.team_folders)
+        access.list_all_albums()
+        requests = dsm.count("SYNO.Foto.Browse.Item.list")
+        assert access.get_file_list("trip").tolist() == expected
+        assert access.get_file_info(12) == expected_info
+        assert dsm.count("SYNO.Foto.Browse.Item.list") == requests
+    finally:
+        access.stop()
+
+
+def test_album_sync_stopped(dsm, monkeypatch):
+    monkeypatch.setattr(synology_photo_access, "ALBUM_PAGE_SIZE", 10)
+    monkeypatch.setattr(synology_photo_access, "ALBUM_FETCH_WORKERS", 1)
+    dsm.albums = [{"name": "trip", "id": 7, "passphrase": "abc", "owner_user_id": 2, "version": 1}]
+    dsm.items = make_items(1, 30)
+    access = SynologyAccess()
+    try:
+        wait_for_scan(access, len(dsm.folders) + len(dsm.team_folders))
+        expected = access.get_file_list("trip").tolist()
+        dsm.items = make_items(1, 95)
+        dsm.albums[0]["version"] = 2
+        access.list_all_albums()
+        dsm.latency = 0.05
+        requests = dsm.count("SYNO.Foto.Browse.Item.list")
+        sync = threading.Thread(target=access.get_album, args=("trip", True))
+        sync.start()
+        while dsm.count("SYNO.Foto.Browse.Item.list") < requests + 2:
+            time.sleep(0.01)
+    finally:
+        access.stop()
+    sync.join()
+    assert dsm.count("SYNO.Foto.Browse.Item.list") < requests + 10  # stopped part way through the 10 pages
+    assert access.get_file_info(31) == {}  # the index kept to the saved album
+    store = SynologyStore(os.path.expanduser(synology_photo_access.DEFAULT_STORE_FILE))
+    try:
+        assert store.album_version("trip") == 1
+        assert [int(info['file_id']) for info in store.load_album("trip")] == expected
+    finally:
+        store.close()
+
+
+def test_album_index():
+    files = [{'file_id': '3', 'fname': 'mine/a/x.jpg', 'exif_datetime': 10.0, 'last_modified': 10.0,
+              'orientation': 6, 'location': 'Sète', 'caption': '/a'},
+             {'file_id': '1', 'fname': 'shared/img.jpg', 'exif_datetime': 20.0, 'last_modified': 21.0,
+              'caption': '/'}]
+    index = AlbumIndex(files)
+    assert len(index) == 2
+    assert index.ids.tolist() == [3, 1]
+    assert index.get(3) == dict(files[0], file_id=3)
+    assert index.get("1") == dict(files[1], file_id=1)
+    assert 1 in index and "3" in index
+    assert index.get(2) is None and "x" not in index
@@ -0,0 +1,41 @@
+import sqlite3
+
+from src.picframe.synology_store import SynologyStore
+
+
+def files(ids, location='Sète'):
+    return [{'file_id': str(i), 'fname': 'mine/a/img{}.jpg'.format(i), 'exif_datetime': 1700000000.0 + i,
+             'last_modified': 1700000000.0 + i, 'orientation': 1, 'location': location, 'caption': '/a'}
+            for i in ids]
+
+
+def test_folders(tmp_path):
+    store = SynologyStore(str(tmp_path / "data" / "synology.db3"))
+    assert store.is_empty()
+    store.save_folders({1: {'name': '/', 'passphrase': '', 'team': False},
+                        2: {'name': '/a', 'passphrase': 'x', 'team': True}})
+    store.save_folders({2: {'name': '/b', 'passphrase': 'x', 'team': True}})
+    assert store.load_folders() == {1: {'name': '/', 'passphrase': '', 'team': False},
+                                    2: {'name': '/b', 'passphrase': 'x', 'team': True}}
+    assert not store.is_empty()
+    store.close()
+
+
+def test_album(tmp_path):
+    db_file = str(tmp_path / "synology.db3")
+    store = SynologyStore(db_file)
+    assert store.album_version("trip") is None
+    assert store.load_album("trip") == []
+    store.save_album("trip", 1, files(range(1, 6)))
+    store.save_album("other", 4, files(range(1, 3)))
+    new_files = files([5, 3, 9]) + files([4], location=None)
+    store.save_album("trip", 2, new_files)
+    assert store.album_version("trip") == 2
+    del new_files[3]['location']  # not stored when None
+    assert store.load_album("trip") == new_files
+    assert len(store.load_album("other")) == 2
+    store.close()
+
+    db = sqlite3.connect(db_file)
+    assert db.execute("SELECT COUNT(*) FROM syno_album_file").fetchone()[0] == 6
+    db.close()